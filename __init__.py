@@ -10,6 +10,7 @@ from . import company
 from . import product
 from . import invoice
 from . import sicore
+from . import padron
 
 __all__ = ['register']
 
@@ -21,12 +22,18 @@ def register():
         account_retencion_ar.TaxWithholdingTypeScale,
         account_retencion_ar.TaxWithholdingSubmitted,
         account_retencion_ar.TaxWithholdingReceived,
+        account_retencion_ar.TaxWithholdingLedger,
+        account_retencion_ar.RebuildLedgerStart,
+        account_retencion_ar.RebuildLedgerResult,
         account_retencion_ar.Perception,
+        account_retencion_ar.Period,
         account_retencion_ar.PrintIIBBSubdivisionStart,
         account_retencion_ar.PrintPerceptionBySubdivisionStart,
         account_voucher_ar.AccountVoucher,
         account_voucher_ar.RecalculateWithholdingsStart,
         party.Party,
+        party.Identifier,
+        party.Address,
         party.PartyExemption,
         party.PartyWithholdingIIBB,
         company.Company,
@@ -35,15 +42,21 @@ def register():
         product.Category,
         product.Product,
         invoice.Invoice,
+        invoice.InvoiceWithholdingBase,
         invoice.InvoiceLine,
         sicore.ExportSICOREStart,
         sicore.ExportSICOREResult,
+        padron.PadronIIBB,
+        padron.PadronIIBBLine,
+        padron.ImportPadronIIBBStart,
         module='account_retencion_ar', type_='model')
     Pool.register(
+        account_retencion_ar.RebuildLedger,
         account_retencion_ar.PrintIIBBSubdivision,
         account_retencion_ar.PrintPerceptionBySubdivision,
         account_voucher_ar.RecalculateWithholdings,
         sicore.ExportSICORE,
+        padron.ImportPadronIIBB,
         module='account_retencion_ar', type_='wizard')
     Pool.register(
         account_retencion_ar.TaxWithholdingSubmittedReport,
@@ -1,22 +1,141 @@
 # This file is part of the account_retencion_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import csv
+import io
+import tempfile
+import uuid
+from bisect import bisect_left
 from decimal import Decimal
-from sql import Null
+from itertools import groupby
+from operator import itemgetter
+from dateutil.relativedelta import relativedelta
+from sql import Conflict, Excluded, Null, Window
+from sql.aggregate import Min, Sum
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp
 
 from trytond import backend
-from trytond.model import ModelView, ModelSQL, fields
-from trytond.wizard import Wizard, StateView, StateReport, Button
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, Index, Unique, fields
+from trytond.wizard import (Wizard, StateView, StateTransition, StateReport,
+    Button)
 from trytond.report import Report
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool, Not, Id
-from trytond.transaction import Transaction
+from trytond.transaction import Transaction, without_check_access
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.modules.company.model import (
     CompanyMultiValueMixin, CompanyValueMixin)
 
 
+class ScaleBracket(object):
+    'Immutable bracket of a Tax Withholding Type scale'
+    __slots__ = ('start_amount', 'end_amount', 'rate',
+        'minimum_non_taxable_amount', 'fixed_withholdable_amount')
+
+    def __init__(self, start_amount, end_amount, rate,
+            minimum_non_taxable_amount, fixed_withholdable_amount):
+        self.start_amount = start_amount
+        self.end_amount = end_amount
+        self.rate = rate
+        self.minimum_non_taxable_amount = minimum_non_taxable_amount
+        self.fixed_withholdable_amount = fixed_withholdable_amount
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class ScaleIndex(object):
+    '''
+    Scales of a Tax Withholding Type sorted by amount.
+    The bracket of an amount is found by bisection when the brackets do not
+    overlap, otherwise the first matching bracket is searched linearly.
+    '''
+    __slots__ = ('brackets', '_end_amounts', '_sorted')
+
+    def __init__(self, brackets):
+        self.brackets = tuple(brackets)
+        self._end_amounts = tuple(
+            b.end_amount if b.end_amount is not None else Decimal('Infinity')
+            for b in self.brackets)
+        self._sorted = all(
+            b.start_amount is not None
+            and b.start_amount <= end
+            and (not i or self._end_amounts[i - 1] <= b.start_amount)
+            for i, (b, end) in enumerate(
+                zip(self.brackets, self._end_amounts)))
+
+    def __bool__(self):
+        return bool(self.brackets)
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def lookup(self, amount):
+        'Return the bracket which includes the amount or None'
+        if self._sorted:
+            i = bisect_left(self._end_amounts, amount)
+            if (i < len(self.brackets)
+                    and self.brackets[i].start_amount <= amount):
+                return self.brackets[i]
+            return None
+        for bracket, end_amount in zip(self.brackets, self._end_amounts):
+            if bracket.start_amount <= amount <= end_amount:
+                return bracket
+        return None
+
+
+class WithholdingTypeValues(object):
+    'Values of a tax withholding type used by the calculations'
+    __slots__ = ('id', 'tax', 'subdivision', 'regime_code', 'regime_name',
+        'minimum_non_taxable_amount', 'rate_registered',
+        'rate_non_registered', 'minimum_withholdable_amount', 'scales',
+        'sequences')
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values[name])
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def get_sequence(self, company):
+        '''
+        Return the id of the sequence of the company or None.
+        Like the multivalue field, the first sequence of the company or
+        without company is used.
+        '''
+        company = int(company) if company else None
+        for company_id, sequence_id in self.sequences:
+            if company_id is None or company_id == company:
+                return sequence_id
+        return None
+
+
+class WithholdingTypeSnapshot(object):
+    'Values of all the tax withholding types keyed by id'
+    __slots__ = ('_values',)
+
+    def __init__(self, values):
+        self._values = {v.id: v for v in values}
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getitem__(self, id):
+        return self._values[int(id)]
+
+    def __contains__(self, id):
+        return int(id) in self._values
+
+    def get(self, id, default=None):
+        return self._values.get(int(id), default)
+
+
 class TaxWithholdingType(ModelSQL, ModelView, CompanyMultiValueMixin):
     'Tax Withholding Type'
     __name__ = 'account.retencion'
@@ -57,6 +176,7 @@ class TaxWithholdingType(ModelSQL, ModelView, CompanyMultiValueMixin):
     minimum_withholdable_amount = fields.Numeric('Minimum Amount to Withhold',
         digits=(16, 2))
     scales = fields.One2Many('account.retencion.scale', 'retencion', 'Scales')
+    _snapshot_cache = Cache('account.retencion.get_snapshot', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -88,6 +208,114 @@ class TaxWithholdingType(ModelSQL, ModelView, CompanyMultiValueMixin):
             return '%s - %s' % (self.name, self.regime_name)
         return self.name
 
+    @classmethod
+    def validate(cls, withholding_types):
+        super().validate(withholding_types)
+        for withholding_type in withholding_types:
+            withholding_type.check_scales()
+
+    def check_scales(self):
+        previous = None
+        for scale in self.scales:
+            if (scale.start_amount is None
+                    or (scale.end_amount is not None
+                        and scale.end_amount < scale.start_amount)):
+                raise UserError(gettext(
+                    'account_retencion_ar.msg_scale_amounts',
+                    retencion=self.rec_name))
+            if previous:
+                if (previous.end_amount is None
+                        or scale.start_amount < previous.end_amount):
+                    raise UserError(gettext(
+                        'account_retencion_ar.msg_scale_overlap',
+                        retencion=self.rec_name,
+                        amount=scale.start_amount))
+                if scale.start_amount - previous.end_amount > Decimal('0.01'):
+                    raise UserError(gettext(
+                        'account_retencion_ar.msg_scale_gap',
+                        retencion=self.rec_name,
+                        start_amount=previous.end_amount,
+                        end_amount=scale.start_amount))
+            previous = scale
+
+    @classmethod
+    def get_snapshot(cls):
+        '''
+        Return the WithholdingTypeSnapshot of the tax withholding types with
+        their scales and company sequences
+        '''
+        pool = Pool()
+        Scale = pool.get('account.retencion.scale')
+        Sequence = pool.get('account.retencion.sequence')
+
+        snapshot = cls._snapshot_cache.get(None)
+        if snapshot is not None:
+            return snapshot
+
+        brackets, sequences = {}, {}
+        for scale in Scale.search([], order=[
+                    ('retencion', 'ASC'),
+                    ('start_amount', 'ASC'),
+                    ('id', 'ASC'),
+                    ]):
+            brackets.setdefault(scale.retencion.id, []).append(ScaleBracket(
+                    scale.start_amount, scale.end_amount, scale.rate,
+                    scale.minimum_non_taxable_amount,
+                    scale.fixed_withholdable_amount))
+        for sequence in Sequence.search([], order=[('id', 'ASC')]):
+            sequences.setdefault(sequence.retencion.id, []).append((
+                    sequence.company.id if sequence.company else None,
+                    sequence.sequence.id if sequence.sequence else None))
+
+        values = []
+        for withholding_type in cls.search([]):
+            values.append(WithholdingTypeValues(
+                    id=withholding_type.id,
+                    tax=withholding_type.tax,
+                    subdivision=(withholding_type.subdivision.id
+                        if withholding_type.subdivision else None),
+                    regime_code=withholding_type.regime_code,
+                    regime_name=withholding_type.regime_name,
+                    minimum_non_taxable_amount=(
+                        withholding_type.minimum_non_taxable_amount),
+                    rate_registered=withholding_type.rate_registered,
+                    rate_non_registered=withholding_type.rate_non_registered,
+                    minimum_withholdable_amount=(
+                        withholding_type.minimum_withholdable_amount),
+                    scales=ScaleIndex(brackets.get(withholding_type.id, [])),
+                    sequences=tuple(sequences.get(withholding_type.id, ()))))
+        snapshot = WithholdingTypeSnapshot(values)
+        cls._snapshot_cache.set(None, snapshot)
+        return snapshot
+
+    @classmethod
+    def create(cls, vlist):
+        withholding_types = super().create(vlist)
+        cls._snapshot_cache.clear()
+        return withholding_types
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._snapshot_cache.clear()
+
+    @classmethod
+    def delete(cls, withholding_types):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        WithholdingBase = pool.get('account.invoice.withholding_base')
+
+        # The summaries are deleted with their regime and computed again
+        # from the lines
+        invoices = Invoice.browse(list({b.invoice.id
+                    for b in WithholdingBase.search([
+                            ('regime', 'in',
+                                [t.id for t in withholding_types]),
+                            ])}))
+        super().delete(withholding_types)
+        cls._snapshot_cache.clear()
+        Invoice.set_withholding_summary(invoices)
+
     @classmethod
     def view_attributes(cls):
         return super().view_attributes() + [
@@ -110,6 +338,28 @@ class TaxWithholdingTypeSequence(ModelSQL, CompanyValueMixin):
             ('company', 'in', [Eval('company', -1), None]),
             ])
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
+        sequences = super().create(vlist)
+        WithholdingType._snapshot_cache.clear()
+        return sequences
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
+        super().write(*args)
+        WithholdingType._snapshot_cache.clear()
+
+    @classmethod
+    def delete(cls, sequences):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
+        super().delete(sequences)
+        WithholdingType._snapshot_cache.clear()
+
 
 class TaxWithholdingTypeScale(ModelSQL, ModelView):
     'Tax Withholding Type Scale'
@@ -130,6 +380,40 @@ class TaxWithholdingTypeScale(ModelSQL, ModelView):
         super().__setup__()
         cls._order.insert(0, ('start_amount', 'ASC'))
 
+    @classmethod
+    def validate(cls, scales):
+        super().validate(scales)
+        # The scales may be modified without their regime
+        for withholding_type in {s.retencion for s in scales
+                if s.retencion}:
+            withholding_type.check_scales()
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
+        scales = super().create(vlist)
+        WithholdingType._snapshot_cache.clear()
+        return scales
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
+        super().write(*args)
+        WithholdingType._snapshot_cache.clear()
+
+    @classmethod
+    def delete(cls, scales):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
+        super().delete(scales)
+        WithholdingType._snapshot_cache.clear()
+
+
+# Key space of the advisory locks taken on the withholding sequences
+_SEQUENCE_LOCK_ID = 178275443
+
 
 class TaxWithholdingSubmitted(ModelSQL, ModelView):
     'Tax Withholding Submitted'
@@ -204,6 +488,13 @@ class TaxWithholdingSubmitted(ModelSQL, ModelView):
     @classmethod
     def __setup__(cls):
         super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.party, Index.Equality()),
+                (t.date, Index.Range()),
+                where=t.state == 'issued'))
         cls._buttons.update({
             'execute_report': {
                 'invisible': Eval('state') != 'issued',
@@ -238,7 +529,9 @@ class TaxWithholdingSubmitted(ModelSQL, ModelView):
     @classmethod
     def check_delete(cls, retenciones):
         for retencion in retenciones:
-            if retencion.voucher and retencion.voucher.state != 'calculated':
+            if (retencion.voucher
+                    and retencion.voucher.state not in {
+                        'draft', 'calculated'}):
                 raise UserError(gettext(
                     'account_retencion_ar.msg_not_delete',
                     retencion=retencion.name))
@@ -255,25 +548,111 @@ class TaxWithholdingSubmitted(ModelSQL, ModelView):
 
     @classmethod
     def get_tax_field(cls, retenciones, names):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
+        snapshot = WithholdingType.get_snapshot()
         result = {}
         for name in names:
             result[name] = {}
-            if cls._fields[name]._type == 'many2one':
-                for r in retenciones:
-                    field = getattr(r.tax, name, None)
-                    result[name][r.id] = field.id if field else None
-            elif cls._fields[name]._type == 'boolean':
-                for r in retenciones:
-                    result[name][r.id] = getattr(r.tax, name, False)
-            else:
-                for r in retenciones:
-                    result[name][r.id] = getattr(r.tax, name, None)
+            for r in retenciones:
+                values = snapshot.get(r.tax.id) if r.tax else None
+                result[name][r.id] = getattr(values, name, None)
         return result
 
     @classmethod
     def search_tax_field(cls, name, clause):
         return [('tax.' + name,) + tuple(clause[1:])]
 
+    @classmethod
+    def get_withheld_amounts(cls, parties, start_date, end_date, taxes=None,
+            group_by_date=False):
+        '''
+        Return the amount issued to the parties between the dates keyed by
+        (party, tax) or by (party, tax, date) if group_by_date is set
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        columns = [table.party, table.tax]
+        if group_by_date:
+            columns.append(table.date)
+        where = ((table.state == 'issued')
+            & (table.date >= start_date)
+            & (table.date <= end_date))
+        if taxes is not None:
+            where &= reduce_ids(table.tax, [int(t) for t in taxes])
+        # SQLite sums the numeric values as floats
+        exp = Decimal(10) ** -cls.amount.digits[1]
+
+        res = {}
+        for sub_parties in grouped_slice([int(p) for p in parties]):
+            cursor.execute(*table.select(*columns, Sum(table.amount),
+                    where=where & reduce_ids(table.party, sub_parties),
+                    group_by=columns))
+            for row in cursor:
+                amount = row[-1]
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                res[tuple(row[:-1])] = amount.quantize(exp)
+        return res
+
+    def _get_preview(self):
+        'Return the computed values of the withholding as a dictionary'
+        res = {
+            'tax': self.tax.id,
+            'tax.rec_name': self.tax.rec_name,
+            }
+        for name in ['payment_amount', 'accumulated_amount',
+                'minimum_non_taxable_amount', 'scale_non_taxable_amount',
+                'taxable_amount', 'rate', 'scale_fixed_amount',
+                'computed_amount', 'minimum_withholdable_amount',
+                'accumulated_withheld', 'amount']:
+            res[name] = getattr(self, name, None)
+        return res
+
+    @classmethod
+    @without_check_access
+    def get_sequence_names(cls, sequence, count):
+        '''
+        Return count consecutive numbers of the sequence reserved at once.
+        On databases with sequences, the block is taken from the database
+        sequence in a short transaction holding an advisory lock on the
+        sequence, so the blocks reserved concurrently do not interleave
+        without locking the sequence record until the end of the
+        transaction. Only the numbers taken by Sequence.get() without lock
+        may fall between the numbers of a block.
+        Otherwise the sequence record is locked to update its next number.
+        '''
+        if not count:
+            return []
+        Sequence = sequence.__class__
+        if sequence.type != 'incremental' or Sequence._strict:
+            return [sequence.get() for _ in range(count)]
+
+        if backend.Database.has_sequence():
+            with Transaction().new_transaction() as transaction:
+                cursor = transaction.connection.cursor()
+                cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)',
+                    (_SEQUENCE_LOCK_ID, sequence.id))
+                cursor.execute('SELECT nextval(\'"%s"\') '
+                    'FROM generate_series(1, %%s)'
+                    % sequence._sql_sequence_name, (count,))
+                numbers = sorted(n for n, in cursor)
+        else:
+            Sequence.lock([sequence])
+            sequence = Sequence(sequence.id)
+            number_next = sequence.number_next_internal
+            increment = sequence.number_increment
+            numbers = [number_next + i * increment for i in range(count)]
+            Sequence.write([sequence], {
+                    'number_next_internal': number_next + count * increment,
+                    })
+
+        prefix = Sequence._process(sequence.prefix)
+        suffix = Sequence._process(sequence.suffix)
+        return ['%s%s%s' % (prefix, f'{n:0>{sequence.padding}d}', suffix)
+            for n in numbers]
+
     @classmethod
     @ModelView.button_action(
         'account_retencion_ar.report_account_retencion_efectuada')
@@ -349,6 +728,175 @@ class TaxWithholdingReceived(ModelSQL, ModelView):
         return super().copy(retenciones, default=current_default)
 
 
+class TaxWithholdingLedger(ModelSQL, ModelView):
+    'Tax Withholding Ledger'
+    __name__ = 'account.retencion.ledger'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, ondelete='CASCADE')
+    party = fields.Many2One('party.party', 'Party', required=True,
+        readonly=True, ondelete='CASCADE')
+    regime = fields.Many2One('account.retencion', 'Regime', required=True,
+        readonly=True, ondelete='CASCADE')
+    month = fields.Date('Month', required=True, readonly=True)
+    base_amount = fields.Numeric('Accumulated Amount',
+        digits=(16, 2), readonly=True)
+    withheld_amount = fields.Numeric('Accumulated Withheld',
+        digits=(16, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('ledger_uniq', Unique(t, t.company, t.party, t.regime, t.month),
+                'account_retencion_ar.msg_ledger_unique'),
+            ]
+        cls._order.insert(0, ('month', 'DESC'))
+
+    @staticmethod
+    def default_base_amount():
+        return Decimal('0.00')
+
+    @staticmethod
+    def default_withheld_amount():
+        return Decimal('0.00')
+
+    @staticmethod
+    def get_month(date):
+        return date + relativedelta(day=1)
+
+    @classmethod
+    def get_amounts(cls, keys):
+        '''
+        Return the accumulated (base, withheld) amounts keyed by
+        (company, party, month, regime) for the (company, party, month) keys
+        '''
+        res = {}
+        if not keys:
+            return res
+        ledgers = cls.search([
+                ('company', 'in', list({k[0] for k in keys})),
+                ('party', 'in', list({k[1] for k in keys})),
+                ('month', 'in', list({k[2] for k in keys})),
+                ])
+        for ledger in ledgers:
+            key = (ledger.company.id, ledger.party.id, ledger.month)
+            if key not in keys:
+                continue
+            res[key + (ledger.regime.id,)] = (
+                ledger.base_amount, ledger.withheld_amount)
+        return res
+
+    @classmethod
+    def add_amounts(cls, amounts):
+        '''
+        Add the (base, withheld) amounts keyed by
+        (company, party, month, regime) to the ledger.
+        The existing rows are incremented in place and the missing ones are
+        inserted, adding to the row created concurrently if any, so the
+        table is never locked.
+        '''
+        if not amounts:
+            return
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        missing = []
+        # Updated in the same order by all the transactions to not deadlock
+        for key in sorted(amounts):
+            company, party, month, regime = key
+            base_amount, withheld_amount = amounts[key]
+            cursor.execute(*table.update(
+                    [table.base_amount, table.withheld_amount,
+                        table.write_uid, table.write_date],
+                    [table.base_amount + base_amount,
+                        table.withheld_amount + withheld_amount,
+                        transaction.user, CurrentTimestamp()],
+                    where=(table.company == company)
+                    & (table.party == party)
+                    & (table.month == month)
+                    & (table.regime == regime)))
+            if not cursor.rowcount:
+                missing.append(key)
+
+        if missing:
+            columns = [table.company, table.party, table.month, table.regime,
+                table.base_amount, table.withheld_amount,
+                table.create_uid, table.create_date]
+            on_conflict = None
+            if database.has_constraint(
+                    Unique(table, table.company, table.party, table.regime,
+                        table.month)):
+                on_conflict = Conflict(table,
+                    indexed_columns=[table.company, table.party,
+                        table.regime, table.month],
+                    columns=[table.base_amount, table.withheld_amount,
+                        table.write_uid, table.write_date],
+                    values=[table.base_amount + Excluded.base_amount,
+                        table.withheld_amount + Excluded.withheld_amount,
+                        Excluded.create_uid, Excluded.create_date])
+            for sub_keys in grouped_slice(missing):
+                cursor.execute(*table.insert(columns,
+                        [list(k) + list(amounts[k])
+                            + [transaction.user, CurrentTimestamp()]
+                            for k in sub_keys],
+                        on_conflict=on_conflict))
+        transaction.counter += 1
+
+    @classmethod
+    def add_vouchers(cls, vouchers, sign=1):
+        pool = Pool()
+        AccountVoucher = pool.get('account.voucher')
+
+        amounts = AccountVoucher.get_withholding_ledger_amounts(vouchers)
+        cls.add_amounts({k: (b * sign, w * sign)
+                for k, (b, w) in amounts.items()})
+
+    @classmethod
+    def rebuild(cls, company, start_date, end_date, check=False):
+        '''
+        Compute again the ledger of the months between start and end dates
+        from the posted payments and return the differences found.
+        If check is set the ledger is not modified.
+        '''
+        pool = Pool()
+        AccountVoucher = pool.get('account.voucher')
+
+        start_month = cls.get_month(start_date)
+        end_month = cls.get_month(end_date)
+        vouchers = AccountVoucher.search([
+                ('company', '=', company),
+                ('voucher_type', '=', 'payment'),
+                ('date', '>=', start_month),
+                ('date', '<=', end_month + relativedelta(day=31)),
+                ('state', '=', 'posted'),
+                ])
+        expected = AccountVoucher.get_withholding_ledger_amounts(vouchers)
+        ledgers = cls.search([
+                ('company', '=', company),
+                ('month', '>=', start_month),
+                ('month', '<=', end_month),
+                ])
+        stored = {(l.company.id, l.party.id, l.month, l.regime.id): (
+                l.base_amount, l.withheld_amount) for l in ledgers}
+
+        zero = (Decimal(0), Decimal(0))
+        differences = []
+        for key in sorted(set(expected) | set(stored),
+                key=lambda k: (k[2], k[1], k[3])):
+            if stored.get(key, zero) != expected.get(key, zero):
+                differences.append(
+                    (key, stored.get(key, zero), expected.get(key, zero)))
+
+        if not check:
+            cls.delete(ledgers)
+            cls.add_amounts(expected)
+        return differences
+
+
 class TaxWithholdingSubmittedReport(Report):
     __name__ = 'account.retencion.efectuada.report'
 
@@ -383,6 +931,69 @@ class TaxWithholdingSubmittedReport(Report):
         return '%s-%s-%s' % (vat_number[:2], vat_number[2:-1], vat_number[-1])
 
 
+class RebuildLedgerStart(ModelView):
+    'Rebuild Tax Withholding Ledger'
+    __name__ = 'account.retencion.ledger.rebuild.start'
+
+    start_date = fields.Date('Start date', required=True)
+    end_date = fields.Date('End date', required=True)
+    check = fields.Boolean('Only check',
+        help='Check this box to list the differences without updating '
+        'the ledger.')
+
+
+class RebuildLedgerResult(ModelView):
+    'Rebuild Tax Withholding Ledger'
+    __name__ = 'account.retencion.ledger.rebuild.result'
+
+    message = fields.Text('Message', readonly=True)
+
+
+class RebuildLedger(Wizard):
+    'Rebuild Tax Withholding Ledger'
+    __name__ = 'account.retencion.ledger.rebuild'
+
+    start = StateView('account.retencion.ledger.rebuild.start',
+        'account_retencion_ar.retencion_ledger_rebuild_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Rebuild', 'rebuild', 'tryton-ok', default=True),
+            ])
+    rebuild = StateTransition()
+    result = StateView('account.retencion.ledger.rebuild.result',
+        'account_retencion_ar.retencion_ledger_rebuild_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_rebuild(self):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Party = pool.get('party.party')
+        WithholdingType = pool.get('account.retencion')
+        Ledger = pool.get('account.retencion.ledger')
+
+        company = Company(Transaction().context.get('company'))
+        differences = Ledger.rebuild(company, self.start.start_date,
+            self.start.end_date, check=self.start.check)
+
+        message = ''
+        for key, stored, expected in differences:
+            _, party, month, regime = key
+            message += '%s - %s - %s: %s / %s -> %s / %s\n' % (
+                month.strftime('%m/%Y'), Party(party).rec_name,
+                WithholdingType(regime).rec_name,
+                stored[0], stored[1], expected[0], expected[1])
+        self.result.message = message
+        return 'result'
+
+    def default_result(self, fields):
+        message = self.result.message
+        self.result.message = None
+        return {
+            'message': message or gettext(
+                'account_retencion_ar.msg_ledger_no_differences'),
+            }
+
+
 class Perception(metaclass=PoolMeta):
     __name__ = 'account.tax'
 
@@ -398,6 +1009,16 @@ class Perception(metaclass=PoolMeta):
     minimum_perceivable_amount = fields.Numeric(
         'Minimum Amount to be Perceived', digits=(16, 2))
 
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Pool().get('account.invoice')._perception_data_cache.clear()
+
+    @classmethod
+    def delete(cls, taxes):
+        super().delete(taxes)
+        Pool().get('account.invoice')._perception_data_cache.clear()
+
     @classmethod
     def view_attributes(cls):
         return super().view_attributes() + [
@@ -407,6 +1028,150 @@ class Perception(metaclass=PoolMeta):
             ]
 
 
+class Period(metaclass=PoolMeta):
+    __name__ = 'account.period'
+
+    @classmethod
+    def reopen(cls, periods):
+        super().reopen(periods)
+        ClosedPeriodReportCacheMixin._closed_period_cache.clear()
+
+
+# Rows read by query of the reports
+_REPORT_PAGE_SIZE = 1000
+# Bytes of CSV kept in memory before spooling to disk
+_CSV_SPOOL_SIZE = 10 * 1024 * 1024
+# Rendered reports of closed periods kept in memory unless configured
+_CLOSED_PERIOD_CACHE_SIZE = 32
+
+
+def stream_rows(query, size=_REPORT_PAGE_SIZE):
+    '''
+    Yield the pages of rows of the query executed once.
+    On PostgreSQL the rows are kept by a server-side cursor until fetched.
+    '''
+    connection = Transaction().connection
+    if backend.name == 'postgresql':
+        cursor = connection.cursor('report_%s' % uuid.uuid4().hex)
+    else:
+        cursor = connection.cursor()
+    try:
+        cursor.execute(*query)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def _get_report_company():
+    pool = Pool()
+    User = pool.get('res.user')
+    return User(Transaction().user).company
+
+
+class ReportRow(object):
+    'Row of a report'
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values[name])
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+class IIBBSubdivisionRow(ReportRow):
+    'Withholding or perception of the IIBB subdivision report'
+    __slots__ = ('date', 'vat_number', 'party_name', 'base', 'amount',
+        'number')
+
+
+class PerceptionRow(ReportRow):
+    'Perception of the perception by subdivision report'
+    __slots__ = ('date', 'party_name', 'vat_number', 'tax_name', 'base',
+        'amount', 'invoice_type', 'invoice_number')
+
+
+class PerceptionGroup(object):
+    'Perceptions of a subdivision'
+    __slots__ = ('name', 'records')
+
+    def __init__(self, name, records):
+        self.name = name
+        self.records = records
+
+
+class CSVReportMixin(object):
+    '''
+    Render the report as CSV when the format of the data is csv, with the
+    header and the rows yielded by the get_csv_rows(data) classmethod
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def _execute(cls, records, header, data, action):
+        if data.get('format') != 'csv':
+            return super()._execute(records, header, data, action)
+        with tempfile.SpooledTemporaryFile(max_size=_CSV_SPOOL_SIZE) as file:
+            text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+            writer = csv.writer(text)
+            for row in cls.get_csv_rows(data):
+                writer.writerow(row)
+            text.flush()
+            text.detach()
+            file.seek(0)
+            return 'csv', file.read()
+
+
+class ClosedPeriodReportCacheMixin(object):
+    'Cache the reports of date ranges made only of closed periods'
+    __slots__ = ()
+    _closed_period_cache = Cache(
+        'account.retencion.closed_period_report', context=False)
+    _closed_period_cache.size_limit = config.getint(
+        'cache', 'account.retencion.closed_period_report',
+        default=_CLOSED_PERIOD_CACHE_SIZE)
+    # The data keys of the report parameters
+    _cache_parameters = ['start_date', 'end_date', 'format']
+
+    @classmethod
+    def _execute(cls, records, header, data, action):
+        company = _get_report_company()
+        if (not company
+                or not cls._is_closed(
+                    company, data['start_date'], data['end_date'])):
+            return super()._execute(records, header, data, action)
+        key = (company.id, cls.__name__, Transaction().language) + tuple(
+            data.get(p) for p in cls._cache_parameters)
+        result = cls._closed_period_cache.get(key)
+        if result is None:
+            result = super()._execute(records, header, data, action)
+            cls._closed_period_cache.set(key, result)
+        return result
+
+    @staticmethod
+    def _is_closed(company, start_date, end_date):
+        'Return if the dates are covered only by closed periods of company'
+        pool = Pool()
+        Period = pool.get('account.period')
+
+        periods = Period.search([
+                ('company', '=', company.id),
+                ('start_date', '<=', end_date),
+                ('end_date', '>=', start_date),
+                ], order=[('start_date', 'ASC')])
+        date = start_date
+        for period in periods:
+            if period.state == 'open' or period.start_date > date:
+                return False
+            date = max(date, period.end_date + relativedelta(days=1))
+        return date > end_date
+
+
 class PrintIIBBSubdivisionStart(ModelView):
     'Retenciones y Percepciones de Ingresos Brutos por Jurisdicción'
     __name__ = 'account.print_iibb_subdivision.start'
@@ -415,6 +1180,14 @@ class PrintIIBBSubdivisionStart(ModelView):
     end_date = fields.Date('End date', required=True)
     subdivision = fields.Many2One('country.subdivision', 'Subdivision',
         domain=[('country.code', '=', 'AR')], required=True)
+    format = fields.Selection([
+        ('report', 'Report'),
+        ('csv', 'CSV'),
+        ], 'Format', required=True)
+
+    @staticmethod
+    def default_format():
+        return 'report'
 
 
 class PrintIIBBSubdivision(Wizard):
@@ -433,6 +1206,7 @@ class PrintIIBBSubdivision(Wizard):
             'start_date': self.start.start_date,
             'end_date': self.start.end_date,
             'subdivision': self.start.subdivision.id,
+            'format': self.start.format,
             }
         return action, data
 
@@ -440,9 +1214,12 @@ class PrintIIBBSubdivision(Wizard):
         return 'end'
 
 
-class IIBBSubdivisionReport(Report):
+class IIBBSubdivisionReport(
+        ClosedPeriodReportCacheMixin, CSVReportMixin, Report):
     'Retenciones y Percepciones de Ingresos Brutos por Jurisdicción'
     __name__ = 'account.iibb_subdivision.report'
+    _cache_parameters = ClosedPeriodReportCacheMixin._cache_parameters + [
+        'subdivision']
 
     @classmethod
     def get_context(cls, records, header, data):
@@ -463,11 +1240,29 @@ class IIBBSubdivisionReport(Report):
             company, data['start_date'], data['end_date'], data['subdivision'])
         return report_context
 
+    @classmethod
+    def get_csv_rows(cls, data):
+        company = _get_report_company()
+        yield ('kind',) + IIBBSubdivisionRow.__slots__
+        for kind, rows in [
+                ('retencion', cls._get_retenciones(company,
+                        data['start_date'], data['end_date'],
+                        data['subdivision'])),
+                ('percepcion', cls._get_percepciones(company,
+                        data['start_date'], data['end_date'],
+                        data['subdivision'])),
+                ]:
+            for row in rows:
+                yield [kind] + [
+                    getattr(row, n) for n in IIBBSubdivisionRow.__slots__]
+
     @classmethod
     def _get_retenciones(cls, company, start_date, end_date, subdivision):
+        'Yield the IIBBSubdivisionRow of the withholdings'
         pool = Pool()
         WithholdingType = pool.get('account.retencion')
         TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        Party = pool.get('party.party')
 
         withholding_type = WithholdingType.search([
             ('tax', '=', 'iibb'),
@@ -475,37 +1270,40 @@ class IIBBSubdivisionReport(Report):
             ('subdivision', '=', subdivision),
             ])
         if not withholding_type:
-            return []
+            return
         withholding_type = withholding_type[0]
 
-        res = []
-        retenciones = TaxWithholdingSubmitted.search([
-            ('tax', '=', withholding_type),
-            ('date', '>=', start_date),
-            ('date', '<=', end_date),
-            ('state', '=', 'issued'),
-            ], order=[
-            ('date', 'ASC'),
-            ('name', 'ASC'),
-            ])
-        for retencion in retenciones:
-            record = {
-                'date': retencion.date,
-                'vat_number': retencion.party.vat_number,
-                'party_name': retencion.party.rec_name,
-                'base': retencion.payment_amount,
-                'amount': retencion.amount,
-                'number': retencion.name,
-                }
-            res.append(record)
-
-        return res
+        retencion = TaxWithholdingSubmitted.__table__()
+        pages = stream_rows(retencion.select(
+                retencion.date, retencion.party, retencion.payment_amount,
+                retencion.amount, retencion.name,
+                where=(retencion.tax == withholding_type.id)
+                & (retencion.date >= start_date)
+                & (retencion.date <= end_date)
+                & (retencion.state == 'issued'),
+                order_by=[retencion.date.asc,
+                    Coalesce(retencion.name, '').asc, retencion.id.asc]))
+        for rows in pages:
+            parties = {p.id: p for p in Party.browse({r[1] for r in rows})}
+            for date, party_id, base, amount, number in rows:
+                party = parties[party_id]
+                yield IIBBSubdivisionRow(
+                    date=date,
+                    vat_number=party.vat_number,
+                    party_name=party.rec_name,
+                    base=base,
+                    amount=amount,
+                    number=number)
 
     @classmethod
     def _get_percepciones(cls, company, start_date, end_date, subdivision):
+        'Yield the IIBBSubdivisionRow of the perceptions'
         pool = Pool()
         PerceptionType = pool.get('account.tax')
         Invoice = pool.get('account.invoice')
+        InvoiceTax = pool.get('account.invoice.tax')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
 
         perception_type = PerceptionType.search([
             ('group.afip_kind', '=', 'provincial'),
@@ -515,37 +1313,50 @@ class IIBBSubdivisionReport(Report):
             ('subdivision', '=', subdivision),
             ])
         if not perception_type:
-            return []
+            return
         perception_type = perception_type[0]
 
-        res = []
-        invoices = Invoice.search([
-            ('company', '=', company),
-            ('type', '=', 'out'),
-            ['OR', ('state', 'in', ['posted', 'paid']),
-                [('state', '=', 'cancelled'), ('number', '!=', None)]],
-            ('move.date', '>=', start_date),
-            ('move.date', '<=', end_date),
-            #('pos.pos_do_not_report', '=', False),
-            ], order=[
-            ('number', 'ASC'),
-            ('invoice_date', 'ASC'),
-            ])
-        for invoice in invoices:
-            for percepcion in invoice.taxes:
-                if percepcion.tax != perception_type:
-                    continue
-                record = {
-                    'date': invoice.invoice_date,
-                    'vat_number': invoice.party.vat_number,
-                    'party_name': invoice.party.rec_name,
-                    'base': invoice.untaxed_amount,
-                    'amount': percepcion.amount,
-                    'number': invoice.number,
-                    }
-                res.append(record)
-
-        return res
+        invoice = Invoice.__table__()
+        invoice_tax = InvoiceTax.__table__()
+        move = Move.__table__()
+        party = Party.__table__()
+        pages = stream_rows(invoice_tax.join(invoice,
+                condition=invoice_tax.invoice == invoice.id
+                ).join(move, condition=invoice.move == move.id
+                ).join(party, condition=invoice.party == party.id
+                ).select(
+                invoice.id, invoice.invoice_date, party.id,
+                invoice.untaxed_amount_cache, invoice_tax.amount,
+                invoice.number,
+                where=(invoice_tax.tax == perception_type.id)
+                & (invoice.company == company.id)
+                & (invoice.type == 'out')
+                & (invoice.state.in_(['posted', 'paid'])
+                    | ((invoice.state == 'cancelled')
+                        & (invoice.number != Null)))
+                & (move.date >= start_date)
+                & (move.date <= end_date),
+                order_by=[Coalesce(invoice.number, '').asc,
+                    invoice.invoice_date.asc, invoice.id.asc,
+                    invoice_tax.id.asc]))
+        for rows in pages:
+            # The CUIT and the name are computed by the party model and the
+            # untaxed amount is not stored for all the invoices
+            parties = {p.id: p for p in Party.browse({r[2] for r in rows})}
+            untaxed_amounts = {i.id: i.untaxed_amount
+                for i in Invoice.browse(
+                    {r[0] for r in rows if r[3] is None})}
+            for invoice_id, date, party_id, base, amount, number in rows:
+                party = parties[party_id]
+                if base is None:
+                    base = untaxed_amounts[invoice_id]
+                yield IIBBSubdivisionRow(
+                    date=date,
+                    vat_number=party.vat_number,
+                    party_name=party.rec_name,
+                    base=base,
+                    amount=amount,
+                    number=number)
 
 
 class PrintPerceptionBySubdivisionStart(ModelView):
@@ -562,11 +1373,19 @@ class PrintPerceptionBySubdivisionStart(ModelView):
         ], 'Use', required=True)
     start_date = fields.Date('Start date', required=True)
     end_date = fields.Date('End date', required=True)
+    format = fields.Selection([
+        ('report', 'Report'),
+        ('csv', 'CSV'),
+        ], 'Format', required=True)
 
     @staticmethod
     def default_kind():
         return 'purchase'
 
+    @staticmethod
+    def default_format():
+        return 'report'
+
     @staticmethod
     def default_date():
         return 'date'
@@ -589,6 +1408,7 @@ class PrintPerceptionBySubdivision(Wizard):
             'date': self.start.date,
             'start_date': self.start.start_date,
             'end_date': self.start.end_date,
+            'format': self.start.format,
             }
         return action, data
 
@@ -596,9 +1416,12 @@ class PrintPerceptionBySubdivision(Wizard):
         return 'end'
 
 
-class PerceptionBySubdivisionReport(Report):
+class PerceptionBySubdivisionReport(
+        ClosedPeriodReportCacheMixin, CSVReportMixin, Report):
     'Percepciones por Jurisdicción'
     __name__ = 'account.perception_subdivision.report'
+    _cache_parameters = ClosedPeriodReportCacheMixin._cache_parameters + [
+        'kind', 'date']
 
     @classmethod
     def get_context(cls, records, header, data):
@@ -613,89 +1436,164 @@ class PerceptionBySubdivisionReport(Report):
         return report_context
 
     @classmethod
-    def _get_records(cls, company, kind, date_used, start_date, end_date):
+    def get_csv_rows(cls, data):
+        company = _get_report_company()
+        yield ('subdivision',) + PerceptionRow.__slots__
+        for group in cls._get_records(company, data['kind'], data['date'],
+                data['start_date'], data['end_date']):
+            for row in group.records:
+                yield [group.name] + [
+                    getattr(row, n) for n in PerceptionRow.__slots__]
+
+    @classmethod
+    def _get_query(cls, company, kind, date_used, start_date, end_date):
+        '''
+        Return the join of the perceptions, its invoice and invoice tax
+        tables, the condition, the subdivision expression and the allowed
+        perceptions by id
+        '''
         pool = Pool()
         Invoice = pool.get('account.invoice')
+        InvoiceTax = pool.get('account.invoice.tax')
+        Move = pool.get('account.move')
+        Address = pool.get('party.address')
         PerceptionType = pool.get('account.tax')
-        Currency = pool.get('currency.currency')
 
-        invoices_clause = [
-            ('company', '=', company),
-            ]
         perceptions_clause = [
             ('company', '=', company),
             ('group.afip_kind', 'in', ['nacional', 'provincial', 'municipal']),
             ]
-
         if kind == 'purchase':
-            invoices_clause.extend([
-                ('type', '=', 'in'),
-                ('state', 'in', ['posted', 'paid']),
-                ])
-            perceptions_clause.extend([
-                ('group.kind', '=', 'purchase'),
-                ])
+            perceptions_clause.append(('group.kind', '=', 'purchase'))
         else:  # kind == 'sale'
-            invoices_clause.extend([
-                ('type', '=', 'out'),
-                ['OR', ('state', 'in', ['posted', 'paid']),
-                    [('state', '=', 'cancelled'), ('number', '!=', None)]],
-                #('pos.pos_do_not_report', '=', False),
-                ])
-            perceptions_clause.extend([
-                ('group.kind', '=', 'sale'),
-                ])
-
+            perceptions_clause.append(('group.kind', '=', 'sale'))
+        perceptions = {
+            p.id: p for p in PerceptionType.search(perceptions_clause)}
+
+        invoice = Invoice.__table__()
+        invoice_tax = InvoiceTax.__table__()
+        move = Move.__table__()
+        address = Address.__table__()
+        tax = PerceptionType.__table__()
+
+        where = ((invoice.company == company.id)
+            & invoice_tax.tax.in_(list(perceptions) or [-1]))
+        if kind == 'purchase':
+            where &= ((invoice.type == 'in')
+                & invoice.state.in_(['posted', 'paid']))
+        else:  # kind == 'sale'
+            where &= ((invoice.type == 'out')
+                & (invoice.state.in_(['posted', 'paid'])
+                    | ((invoice.state == 'cancelled')
+                        & (invoice.number != Null))))
         if date_used == 'post_date':
-            invoices_clause.extend([
-                ('move.post_date', '>=', start_date),
-                ('move.post_date', '<=', end_date),
-                ])
+            move_date = move.post_date
         else:  # date_used == 'date':
-            invoices_clause.extend([
-                ('move.date', '>=', start_date),
-                ('move.date', '<=', end_date),
-                ])
+            move_date = move.date
+        where &= (move_date >= start_date) & (move_date <= end_date)
+
+        from_ = invoice_tax.join(invoice,
+            condition=invoice_tax.invoice == invoice.id
+            ).join(move, condition=invoice.move == move.id
+            ).join(tax, condition=invoice_tax.tax == tax.id
+            ).join(address, 'LEFT',
+            condition=invoice.invoice_address == address.id)
+        # 0 for the perceptions without subdivision
+        subdivision = Coalesce(tax.subdivision, address.subdivision, 0)
+        return from_, invoice, invoice_tax, where, subdivision, perceptions
 
-        res = {}
-        allowed_perceptions = PerceptionType.search(perceptions_clause)
-        invoices = Invoice.search(invoices_clause, order=[
-            ('invoice_date', 'ASC'),
-            ('number', 'ASC'),
-            ])
-        for invoice in invoices:
-            invoice_subdivision = invoice.invoice_address.subdivision
-            currency_rate = invoice.currency_rate or Decimal(1)
-            for percepcion in invoice.taxes:
-                if percepcion.tax not in allowed_perceptions:
-                    continue
-                tax_subdivision = percepcion.tax.subdivision
-                subdivision = tax_subdivision or invoice_subdivision
-                key = subdivision and subdivision.id or None
-                if key not in res:
-                    res[key] = {
-                        'name': key and subdivision.name or 'Sin Jurisdicción',
-                        'records': [],
-                        }
-                with Transaction().set_context(currency_rate=currency_rate):
-                    record = {
-                        'date': invoice.invoice_date,
-                        'party_name': invoice.party.rec_name,
-                        'vat_number': invoice.party.vat_number,
-                        'tax_name': percepcion.tax.name,
-                        'base': Currency.compute(invoice.currency,
-                            invoice.untaxed_amount, invoice.company.currency),
-                        'amount': Currency.compute(invoice.currency,
-                            percepcion.amount, invoice.company.currency),
-                        }
+    @classmethod
+    def _get_records(cls, company, kind, date_used, start_date, end_date):
+        '''
+        Yield the PerceptionGroup of each subdivision in the order of their
+        first invoice date.
+        The perceptions are streamed by one query so the records of each
+        group must be iterated before the next group.
+        '''
+        pool = Pool()
+        Subdivision = pool.get('country.subdivision')
+
+        rows = cls._get_perception_rows(
+            company, kind, date_used, start_date, end_date)
+        for subdivision_id, group in groupby(rows, key=itemgetter(0)):
+            if subdivision_id:
+                name = Subdivision(subdivision_id).name
+            else:
+                name = 'Sin Jurisdicción'
+            yield PerceptionGroup(name, (row for _, row in group))
+
+    @classmethod
+    def _get_perception_rows(cls, company, kind, date_used, start_date,
+            end_date):
+        '''
+        Yield the subdivision id and the PerceptionRow of the perceptions
+        ordered by subdivision
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+        Currency = pool.get('currency.currency')
+
+        (from_, invoice, invoice_tax, where, subdivision,
+            perceptions) = cls._get_query(
+            company, kind, date_used, start_date, end_date)
+        if not perceptions:
+            return
+        first_date = Min(invoice.invoice_date, window=Window([subdivision]))
+        pages = stream_rows(from_.select(
+                invoice.id, invoice.invoice_date, invoice.party,
+                invoice_tax.tax, invoice.currency, invoice.currency_rate,
+                invoice.untaxed_amount_cache, invoice_tax.amount,
+                invoice.number, invoice.reference, subdivision,
+                where=where,
+                order_by=[first_date.asc, subdivision.asc,
+                    invoice.invoice_date.asc,
+                    Coalesce(invoice.number, '').asc, invoice.id.asc,
+                    invoice_tax.id.asc]))
+
+        company_currency = company.currency
+        for rows in pages:
+            # Values computed by the models are read once for the page
+            invoices = {i.id: i for i in Invoice.browse({r[0] for r in rows})}
+            parties = {p.id: p for p in Party.browse({r[2] for r in rows})}
+
+            # Convert the amounts once per currency and rate
+            amounts = [None] * len(rows)
+            groups = {}
+            for index, row in enumerate(rows):
+                groups.setdefault((row[4], row[5]), []).append(index)
+            for (currency_id, currency_rate), group in groups.items():
+                currency = Currency(currency_id)
+                with Transaction().set_context(
+                        currency_rate=currency_rate or Decimal(1)):
+                    for index in group:
+                        invoice_id, base, amount = (
+                            rows[index][0], rows[index][6], rows[index][7])
+                        if base is None:
+                            base = invoices[invoice_id].untaxed_amount
+                        amounts[index] = (
+                            Currency.compute(
+                                currency, base, company_currency),
+                            Currency.compute(
+                                currency, amount, company_currency))
+
+            for row, (base, amount) in zip(rows, amounts):
+                (invoice_id, date, party_id, tax_id, _, _, _, _,
+                    number, reference, subdivision_id) = row
+                party = parties[party_id]
+                invoice = invoices[invoice_id]
                 if kind == 'purchase':
-                    record['invoice_type'] = (
-                        invoice.tipo_comprobante_string)
-                    record['invoice_number'] = invoice.reference
+                    invoice_type = invoice.tipo_comprobante_string
+                    invoice_number = reference
                 else:  # kind == 'sale'
-                    record['invoice_type'] = (
-                        invoice.invoice_type.invoice_type_string)
-                    record['invoice_number'] = invoice.number
-                res[key]['records'].append(record)
-
-        return res.values()
+                    invoice_type = invoice.invoice_type.invoice_type_string
+                    invoice_number = number
+                yield subdivision_id, PerceptionRow(
+                    date=date,
+                    party_name=party.rec_name,
+                    vat_number=party.vat_number,
+                    tax_name=perceptions[tax_id].name,
+                    base=base,
+                    amount=amount,
+                    invoice_type=invoice_type,
+                    invoice_number=invoice_number)
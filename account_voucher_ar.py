@@ -1,16 +1,129 @@
 # This file is part of the account_retencion_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime as dt
 from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 
-from trytond.model import Workflow, ModelView, fields
+from sql import Union
+from sql.operators import Like
+
+from trytond.model import Model, Workflow, ModelView, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Or, And
+from trytond.rpc import RPC
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from trytond.tools import grouped_slice, reduce_ids
+
+from .account_retencion_ar import ClosedPeriodReportCacheMixin
+from .instrumentation import phase, profile
+from .withholding import WithholdingInput, compute_withholding
+
+# Time after which a dequeued task of a payment run which is not finished is
+# considered failed
+_PAYMENT_RUN_TIMEOUT = dt.timedelta(hours=1)
+
+
+class WithholdingBatch(object):
+    '''
+    Records shared by the withholding calculation of a set of vouchers.
+    Invoices, the withholding ledger and the issued withholdings are loaded
+    once for every (party, month) of the set instead of per voucher, and the
+    computed withholdings are saved together.
+    '''
+
+    @phase('load_batch')
+    def __init__(self, vouchers):
+        super(WithholdingBatch, self).__init__()
+        self.vouchers = list(vouchers)
+        self.withholdings = []
+        self.taxes = {}
+        self.invoices = {}
+        self._invoice_vouchers = set()
+        self.ledger_amounts = {}
+        self._ledger_keys = set()
+        self.withheld_amounts = {}
+        self._withheld_keys = set()
+        self._load_invoices(self.vouchers)
+        self._load_exemptions(self.vouchers)
+
+    def _get_key(self, voucher):
+        pool = Pool()
+        Ledger = pool.get('account.retencion.ledger')
+        return (voucher.company.id, voucher.party.id,
+            Ledger.get_month(voucher.date))
+
+    def _get_keys(self, voucher):
+        keys = {self._get_key(voucher)}
+        for other in self.vouchers:
+            if other.company and other.party and other.date:
+                keys.add(self._get_key(other))
+        return keys
+
+    def _load_invoices(self, vouchers):
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+
+        vouchers = [v for v in vouchers if v.id not in self._invoice_vouchers]
+        self.invoices.update(Voucher.get_origin_invoices(vouchers))
+        self._invoice_vouchers.update(v.id for v in vouchers)
+
+    def _load_exemptions(self, vouchers):
+        pool = Pool()
+        PartyExemption = pool.get('party.exemption')
+        # Fill the cache used by Party.is_exempt
+        PartyExemption.get_exemptions({v.party for v in vouchers if v.party})
+
+    def get_invoice(self, line):
+        'Return the invoice origin of the voucher line or None'
+        if not line.move_line:
+            return None
+        if line.voucher.id not in self._invoice_vouchers:
+            self._load_invoices([line.voucher])
+        return self.invoices.get(line.move_line.id)
+
+    def get_ledger_amounts(self, voucher, tax_id):
+        '''
+        Return the (base, withheld) amounts accumulated by the posted
+        payments to the party in the month of voucher
+        '''
+        pool = Pool()
+        Ledger = pool.get('account.retencion.ledger')
+
+        key = self._get_key(voucher)
+        if key not in self._ledger_keys:
+            keys = self._get_keys(voucher) - self._ledger_keys
+            self.ledger_amounts.update(Ledger.get_amounts(keys))
+            self._ledger_keys.update(keys)
+        return self.ledger_amounts.get(
+            key + (tax_id,), (Decimal(0), Decimal(0)))
+
+    def get_withheld_amount(self, voucher, tax_id):
+        'Return the amount withheld to the party in the month of voucher'
+        pool = Pool()
+        Ledger = pool.get('account.retencion.ledger')
+        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+
+        key = self._get_key(voucher)[1:]
+        if key not in self._withheld_keys:
+            keys = {k[1:] for k in self._get_keys(voucher)}
+            keys -= self._withheld_keys
+            months = [m for _, m in keys]
+            amounts = TaxWithholdingSubmitted.get_withheld_amounts(
+                {p for p, _ in keys}, min(months),
+                max(months) + relativedelta(day=31), group_by_date=True)
+            for (party, tax, date), amount in amounts.items():
+                month_key = (party, Ledger.get_month(date))
+                if month_key not in keys:
+                    continue
+                self.withheld_amounts.setdefault(
+                    month_key + (tax,), Decimal(0))
+                self.withheld_amounts[month_key + (tax,)] += amount
+            self._withheld_keys.update(keys)
+        return self.withheld_amounts.get(key + (tax_id,), Decimal(0))
 
 
 class AccountVoucher(metaclass=PoolMeta):
@@ -76,6 +189,11 @@ class AccountVoucher(metaclass=PoolMeta):
                 'depends': ['state'],
                 },
             })
+        cls.__rpc__.update({
+                'preview_withholdings': RPC(readonly=True, instantiate=0),
+                'calculate_payment_run': RPC(readonly=False, instantiate=0),
+                'get_payment_run_states': RPC(),
+                })
 
     @fields.depends('retenciones_efectuadas', 'retenciones_soportadas')
     def on_change_with_amount(self, name=None):
@@ -90,25 +208,235 @@ class AccountVoucher(metaclass=PoolMeta):
                     amount += retencion.amount
         return amount
 
+    @classmethod
+    def delete(cls, vouchers):
+        pool = Pool()
+        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        TaxWithholdingSubmitted.delete([w for v in vouchers
+                for w in v.retenciones_efectuadas if w.state == 'draft'])
+        super().delete(vouchers)
+
     @classmethod
     @ModelView.button
     @Workflow.transition('draft')
     def draft(cls, vouchers):
+        # The withholdings are kept to be updated in place by calculate
+        pass
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('calculated')
+    def calculate(cls, vouchers):
+        cls.calculate_withholdings_batch(vouchers)
+
+    @classmethod
+    def calculate_payment_run(cls, vouchers):
+        '''
+        Queue the calculation of vouchers in one task per party so the
+        workers can run them in parallel, each in its own transaction.
+        Return the task id keyed by party id.
+        '''
+        partitions = {}
         for voucher in vouchers:
-            voucher.delete_withholding()
+            if not voucher.party:
+                raise UserError(gettext(
+                        'account_retencion_ar.msg_payment_run_no_party',
+                        voucher=voucher.rec_name))
+            partitions.setdefault(voucher.party.id, []).append(voucher)
+
+        tasks = {}
+        # All the vouchers of a party stay in the same task for the monthly
+        # accumulation of its withholdings
+        with Transaction().set_context(
+                queue_name='account.voucher.calculate', queue_batch=False):
+            for party_id, party_vouchers in partitions.items():
+                task_id, = cls.__queue__.calculate(party_vouchers)
+                tasks[party_id] = task_id
+        return tasks
+
+    @classmethod
+    def get_payment_run_states(cls, tasks):
+        '''
+        Return the state of the tasks returned by calculate_payment_run keyed
+        by party id: 'pending', 'done' or 'failed'.
+        The tasks are failed when they reported an error, when they are
+        missing or when they are still not finished long after a worker
+        took them, as the workers do not record the crashes.
+        '''
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        Error = pool.get('ir.error')
+
+        task_ids = [int(t) for t in tasks.values()]
+        queued = {}
+        for sub_ids in grouped_slice(task_ids):
+            for task in Queue.search([('id', 'in', list(sub_ids))]):
+                queued[task.id] = task
+        failed = {e.origin.id for e in Error.search([
+                    ('origin', 'in', ['ir.queue,%s' % i for i in task_ids]),
+                    ('state', '!=', 'solved'),
+                    ])}
+
+        timeout = dt.datetime.now() - _PAYMENT_RUN_TIMEOUT
+        res = {}
+        for party_id, task_id in tasks.items():
+            task = queued.get(int(task_id))
+            if int(task_id) in failed:
+                state = 'failed'
+            elif task is None:
+                # The queue keeps the finished tasks for days, so a missing
+                # task has been rolled back or removed before running
+                state = 'failed'
+            elif task.finished_at:
+                state = 'done'
+            elif task.dequeued_at and task.dequeued_at < timeout:
+                state = 'failed'
+            else:
+                state = 'pending'
+            res[party_id] = state
+        return res
 
-    def delete_withholding(self):
+    @classmethod
+    def get_origin_invoices(cls, vouchers):
+        '''
+        Return the invoices origin of the lines and debit lines of the
+        vouchers keyed by move line id
+        '''
+        pool = Pool()
+        VoucherLine = pool.get('account.voucher.line')
+        VoucherLineDebit = pool.get('account.voucher.line.debits')
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Invoice = pool.get('account.invoice')
+        cursor = Transaction().connection.cursor()
+        move_line = MoveLine.__table__()
+        move = Move.__table__()
+
+        origins = {}
+        for sub_ids in grouped_slice([v.id for v in vouchers]):
+            queries = []
+            for Line in (VoucherLine, VoucherLineDebit):
+                line = Line.__table__()
+                queries.append(line.join(move_line,
+                        condition=line.move_line == move_line.id
+                        ).join(move,
+                        condition=move_line.move == move.id
+                        ).select(move_line.id, move.origin,
+                        where=reduce_ids(line.voucher, sub_ids)
+                        & Like(move.origin, 'account.invoice,%')))
+            cursor.execute(*Union(*queries))
+            for move_line_id, origin in cursor:
+                origins[move_line_id] = int(origin.split(',')[1])
+
+        invoices = {i.id: i for i in Invoice.browse(set(origins.values()))}
+        if invoices:
+            # Invoices browsed together share their cache so reading the
+            # fields used by the calculations on one loads them for all
+            invoice = next(iter(invoices.values()))
+            invoice.total_amount, invoice.untaxed_amount
+            invoice.pyafipws_imp_iva, invoice.tipo_comprobante
+            invoice.withholding_m_type
+            for base in invoice.withholding_bases:
+                base.regime
+        return {l: invoices[i] for l, i in origins.items()}
+
+    @classmethod
+    def calculate_withholdings_batch(cls, vouchers, context={}):
+        with profile('calculate_withholdings_batch', vouchers=len(vouchers)):
+            batch = WithholdingBatch(vouchers)
+            for voucher in vouchers:
+                voucher.calculate_withholdings(context, batch=batch)
+            cls.update_withholdings(vouchers, batch.withholdings, batch.taxes)
+
+    @classmethod
+    @phase('save')
+    def update_withholdings(cls, vouchers, withholdings, taxes):
+        '''
+        Replace the draft withholdings submitted of the vouchers by
+        withholdings, updating the existing records in place.
+        Only the computed records of the taxes calculated for each voucher,
+        given by taxes keyed by voucher id, are replaced; the withholdings
+        entered manually are kept. The existing records found in
+        withholdings are left untouched.
+        '''
         pool = Pool()
         TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
-        if self.retenciones_efectuadas:
-            TaxWithholdingSubmitted.delete(self.retenciones_efectuadas)
+
+        names = ['party', 'date', 'payment_amount', 'accumulated_amount',
+            'minimum_non_taxable_amount', 'scale_non_taxable_amount',
+            'taxable_amount', 'rate', 'scale_fixed_amount', 'computed_amount',
+            'minimum_withholdable_amount', 'accumulated_withheld', 'amount']
+
+        def value(withholding, name):
+            value = getattr(withholding, name, None)
+            if isinstance(value, Model):
+                value = value.id
+            return value
+
+        existing = {}
+        for voucher in vouchers:
+            for withholding in voucher.retenciones_efectuadas:
+                if (withholding.state == 'draft'
+                        and withholding.tax
+                        and withholding.computed_amount is not None
+                        and withholding.tax.tax in taxes.get(voucher.id, ())):
+                    existing.setdefault(
+                        (voucher.id, withholding.tax.id), []).append(
+                        withholding)
+
+        to_create, to_write = [], []
+        for withholding in withholdings:
+            key = (withholding.voucher.id, withholding.tax.id)
+            if withholding.id is not None and withholding.id >= 0:
+                # Kept unchanged as its input did not change
+                if withholding in existing.get(key, []):
+                    existing[key].remove(withholding)
+                continue
+            if not existing.get(key):
+                to_create.append(withholding)
+                continue
+            record = existing[key].pop(0)
+            values = {}
+            for name in names:
+                new_value = value(withholding, name)
+                if value(record, name) != new_value:
+                    values[name] = new_value
+            if values:
+                to_write.extend(([record], values))
+        to_delete = [w for records in existing.values() for w in records]
+
+        if to_delete:
+            TaxWithholdingSubmitted.delete(to_delete)
+        if to_write:
+            TaxWithholdingSubmitted.write(*to_write)
+        if to_create:
+            TaxWithholdingSubmitted.save(to_create)
 
     @classmethod
-    @ModelView.button
-    @Workflow.transition('calculated')
-    def calculate(cls, vouchers):
+    def preview_withholdings(cls, vouchers, amounts=None):
+        '''
+        Return for each payment voucher id the withholdings that would be
+        calculated, without saving them.
+        amounts may map voucher ids to a payment amount to use instead of
+        the voucher lines, like the Recalculate Withholdings wizard does.
+        '''
+        amounts = {int(k): Decimal(str(v))
+            for k, v in (amounts or {}).items()}
+        vouchers = [v for v in vouchers if v.voucher_type == 'payment']
+        batch = WithholdingBatch(vouchers)
+
+        res = {}
         for voucher in vouchers:
-            voucher.calculate_withholdings()
+            context = {}
+            if voucher.id in amounts:
+                context = {
+                    'amount': amounts[voucher.id],
+                    'vat_rate': Decimal(0.21),
+                    'amount_option': 'add',
+                    }
+            res[voucher.id] = [w._get_preview()
+                for w in voucher.calculate_withholdings(context, batch=batch)]
+        return res
 
     @classmethod
     @ModelView.button_action(
@@ -116,105 +444,156 @@ class AccountVoucher(metaclass=PoolMeta):
     def recalculate(cls, vouchers):
         pass
 
-    def calculate_withholdings(self, context={}):
-        if self._applies_withholding_ganancias():
-            self._calculate_withholding_ganancias(context)
-        if self._applies_withholding_iva():
-            self._calculate_withholding_iva(context)
-        if self._applies_withholding_iibb():
-            self._calculate_withholding_iibb(context)
+    def calculate_withholdings(self, context={}, batch=None):
+        '''
+        Return the withholdings computed for the voucher.
+        They replace the draft withholdings of the voucher unless batch is
+        given, in which case they are added to the withholdings of the batch
+        to be saved all at once.
+        '''
+        with profile('calculate_withholdings', voucher=self.id):
+            # The computed withholdings of the taxes which no longer apply
+            # are removed
+            withholdings, taxes = [], {'gana', 'iva', 'iibb'}
+            shared_batch = batch
+            if batch is None:
+                batch = WithholdingBatch([self])
+            if self._applies_withholding_ganancias():
+                withholdings.extend(
+                    self._calculate_withholding_ganancias(context, batch))
+            if self._applies_withholding_iva(batch):
+                withholdings.extend(
+                    self._calculate_withholding_iva(context, batch))
+            if self._applies_withholding_iibb():
+                withholdings.extend(
+                    self._calculate_withholding_iibb(context, batch))
+
+            if shared_batch is None:
+                self.update_withholdings(
+                    [self], withholdings, {self.id: taxes})
+            else:
+                shared_batch.withholdings.extend(withholdings)
+                shared_batch.taxes[self.id] = taxes
+        return withholdings
 
     def _applies_withholding_ganancias(self):
-        if self.company.ganancias_agente_retencion:
+        if self.company.get_withholding_profile().ganancias_agente_retencion:
             return True
         return False
 
-    def _applies_withholding_iva(self):
-        pool = Pool()
-        Invoice = pool.get('account.invoice')
-
-        if self.company.iva_agente_retencion:
+    @phase('applies_iva')
+    def _applies_withholding_iva(self, batch=None):
+        if self.company.get_withholding_profile().iva_agente_retencion:
             return True
 
+        if batch is None:
+            batch = WithholdingBatch([self])
         for line in self.lines:
-            origin = str(line.move_line.move_origin)
-            if origin[:origin.find(',')] != 'account.invoice':
+            invoice = batch.get_invoice(line)
+            if not invoice:
                 continue
-            invoice = Invoice(line.move_line.move_origin.id)
-            if invoice.tipo_comprobante in (
-                    '051', '052', '053', '054', '118', '119', '120'):
+            if invoice.is_withholding_m_type():
                 return True
 
         return False
 
     def _applies_withholding_iibb(self):
-        if self.company.iibb_agente_retencion:
+        if self.company.get_withholding_profile().iibb_agente_retencion:
             return True
         return False
 
-    def _calculate_withholding_ganancias(self, context={}):
+    @phase('exemptions')
+    def _remove_withholding_exemptions(self, withholding_data):
+        for tax_id, data in list(withholding_data.items()):
+            if self.party.is_exempt(data['tax'], self.date):
+                del withholding_data[tax_id]
+
+    def _get_withholding_input(self, data):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
+        withholding_type = WithholdingType.get_snapshot()[data['tax'].id]
+        return WithholdingInput(
+            payment_amount=data['payment_amount'],
+            rate=data['rate'],
+            accumulated_amount=data['accumulated_amount'],
+            accumulated_withheld=data['accumulated_withheld'],
+            minimum_non_taxable_amount=(
+                withholding_type.minimum_non_taxable_amount),
+            minimum_withholdable_amount=(
+                withholding_type.minimum_withholdable_amount),
+            scale_non_taxable_amount=data.get('scale_non_taxable_amount'),
+            scale_fixed_amount=data.get('scale_fixed_amount'))
+
+    def _compute_withholding(self, data, scale=False):
+        '''
+        Return the withholding computed from data or None if nothing must be
+        withheld.
+        The calculated withholding of the regime is returned unchanged when
+        its input did not change since it was computed.
+        '''
+        input = self._get_withholding_input(data)
+        previous = self._get_calculated_withholding(data['tax'])
+        if (previous
+                and previous.party == self.party
+                and previous.date == self.date
+                and WithholdingInput.from_result(previous) == input):
+            return previous
+        result = compute_withholding(input)
+        if result is None:
+            return None
+        return self._get_withholding(data['tax'], result, scale=scale)
+
+    def _get_calculated_withholding(self, withholding_type):
+        'Return the draft computed withholding of the regime or None'
+        for withholding in self.retenciones_efectuadas:
+            if (withholding.state == 'draft'
+                    and withholding.tax == withholding_type
+                    and withholding.computed_amount is not None):
+                return withholding
+
+    def _get_withholding(self, withholding_type, result, scale=False):
         pool = Pool()
         TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
 
-        quantize = Decimal(10) ** -Decimal(2)
-
-        withholding_data = self._get_withholding_data_ganancias(context)
+        withholding = TaxWithholdingSubmitted()
+        withholding.tax = withholding_type
+        withholding.voucher = self
+        withholding.party = self.party
+        withholding.date = self.date
+        withholding.payment_amount = result.payment_amount
+        withholding.accumulated_amount = result.accumulated_amount
+        withholding.minimum_non_taxable_amount = (
+            result.minimum_non_taxable_amount)
+        withholding.taxable_amount = result.taxable_amount
+        withholding.rate = result.rate
+        if scale:
+            withholding.scale_non_taxable_amount = (
+                result.scale_non_taxable_amount)
+            withholding.scale_fixed_amount = result.scale_fixed_amount
+        withholding.computed_amount = result.computed_amount
+        withholding.minimum_withholdable_amount = (
+            result.minimum_withholdable_amount)
+        withholding.accumulated_withheld = result.accumulated_withheld
+        withholding.amount = result.amount
+        return withholding
+
+    @phase('calculate_ganancias')
+    def _calculate_withholding_ganancias(self, context={}, batch=None):
+        withholdings = []
+        withholding_data = self._get_withholding_data_ganancias(context, batch)
         for data in withholding_data.values():
+            withholding = self._compute_withholding(data, scale=True)
+            if withholding:
+                withholdings.append(withholding)
+        return withholdings
 
-            withholding_type = data['tax']
-
-            payment_amount = data['payment_amount']
-            accumulated_amount = data['accumulated_amount'] + payment_amount
-            minimum_non_taxable_amount = (
-                withholding_type.minimum_non_taxable_amount or Decimal(0))
-            if accumulated_amount < minimum_non_taxable_amount:
-                continue
-
-            taxable_amount = accumulated_amount - minimum_non_taxable_amount
-            rate = data['rate']
-            if not rate:
-                continue
-
-            scale_non_taxable_amount = data['scale_non_taxable_amount']
-            computed_amount = ((taxable_amount - scale_non_taxable_amount) *
-                rate / Decimal(100))
-            computed_amount = computed_amount.quantize(quantize)
-
-            scale_fixed_amount = data['scale_fixed_amount']
-            computed_amount += scale_fixed_amount
-
-            minimum_withholdable_amount = (
-                withholding_type.minimum_withholdable_amount or Decimal(0))
-            if computed_amount < minimum_withholdable_amount:
-                continue
-
-            accumulated_withheld = data['accumulated_withheld']
-            amount = computed_amount - accumulated_withheld
-
-            withholding = TaxWithholdingSubmitted()
-            withholding.tax = withholding_type
-            withholding.voucher = self
-            withholding.party = self.party
-            withholding.date = self.date
-            withholding.payment_amount = payment_amount
-            withholding.accumulated_amount = accumulated_amount
-            withholding.minimum_non_taxable_amount = minimum_non_taxable_amount
-            withholding.scale_non_taxable_amount = scale_non_taxable_amount
-            withholding.taxable_amount = taxable_amount
-            withholding.rate = rate
-            withholding.scale_fixed_amount = scale_fixed_amount
-            withholding.computed_amount = computed_amount
-            withholding.minimum_withholdable_amount = (
-                minimum_withholdable_amount)
-            withholding.accumulated_withheld = accumulated_withheld
-            withholding.amount = amount
-            withholding.save()
-
-    def _get_withholding_data_ganancias(self, context={}):
+    @phase('data_ganancias')
+    def _get_withholding_data_ganancias(self, context={}, batch=None):
         pool = Pool()
-        Invoice = pool.get('account.invoice')
-        AccountVoucher = pool.get('account.voucher')
-        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        WithholdingType = pool.get('account.retencion')
+
+        if batch is None:
+            batch = WithholdingBatch([self])
 
         # Verify conditions
         if self.party.iva_condition not in ['responsable_inscripto', 'exento']:
@@ -230,7 +609,10 @@ class AccountVoucher(metaclass=PoolMeta):
 
         default_regimen = self.party.ganancias_regimen
         if not default_regimen:
-            default_regimen = self.company.ganancias_regimen_retencion
+            profile = self.company.get_withholding_profile()
+            if profile.ganancias_regimen_retencion:
+                default_regimen = WithholdingType(
+                    profile.ganancias_regimen_retencion)
         if not default_regimen:
             return {}
 
@@ -259,19 +641,17 @@ class AccountVoucher(metaclass=PoolMeta):
         else:
             used_regimen = None
             for line in self.lines:
-                origin = str(line.move_line.move_origin)
-                if origin[:origin.find(',')] != 'account.invoice':
+                invoice = batch.get_invoice(line)
+                if not invoice:
                     continue
                 if not line.amount:
                     continue
 
-                invoice = Invoice(line.move_line.move_origin.id)
                 payment_rate = Decimal(line.amount / invoice.total_amount)
 
-                for invoice_line in invoice.lines:
-                    if invoice_line.type != 'line':
-                        continue
-                    tax = invoice_line.ganancias_regimen or default_regimen
+                for regime, base_amount in invoice.get_withholding_bases():
+                    tax = (WithholdingType(regime) if regime
+                        else default_regimen)
                     if tax.id not in res:
                         res[tax.id] = {
                             'tax': tax,
@@ -281,14 +661,13 @@ class AccountVoucher(metaclass=PoolMeta):
                             }
                     if used_regimen is None:
                         used_regimen = tax
-                    payment_amount = invoice_line.amount * payment_rate
+                    payment_amount = base_amount * payment_rate
                     res[tax.id]['payment_amount'] += (
                         payment_amount.quantize(quantize))
             if used_regimen and self.lines_debits:
                 for line in self.lines_debits:
-                    origin = str(line.move_line.move_origin)
-                    if origin[:origin.find(',')] == 'account.invoice':
-                        invoice = Invoice(line.move_line.move_origin.id)
+                    invoice = batch.get_invoice(line)
+                    if invoice:
                         vat_rate = Decimal(invoice.untaxed_amount /
                             invoice.total_amount)
                         payment_amount = line.amount_original * vat_rate
@@ -298,78 +677,17 @@ class AccountVoucher(metaclass=PoolMeta):
                         payment_amount.quantize(quantize))
 
         # Verify exemptions
-        taxes = [x for x in res.keys()]
-        for exemption in self.party.exemptions:
-            for tax_id in taxes:
-                reference = 'account.retencion,%s' % str(tax_id)
-                if (str(exemption.tax) == reference and
-                        exemption.end_date >= self.date):
-                    del res[tax_id]
+        self._remove_withholding_exemptions(res)
 
         # Accumulated Amount
-        period_first_date = self.date + relativedelta(day=1)
-        period_last_date = self.date + relativedelta(day=31)
-        vouchers = AccountVoucher.search([
-            ('voucher_type', '=', 'payment'),
-            ('party', '=', self.party),
-            ('date', '>=', period_first_date),
-            ('date', '<=', period_last_date),
-            ('state', '=', 'posted'),
-            ])
-        for voucher in vouchers:
-            used_regimen = None
-            for line in voucher.lines:
-                origin = str(line.move_line.move_origin)
-                if origin[:origin.find(',')] != 'account.invoice':
-                    continue
-                if not line.amount:
-                    continue
-
-                invoice = Invoice(line.move_line.move_origin.id)
-                payment_rate = Decimal(line.amount / invoice.total_amount)
-
-                for invoice_line in invoice.lines:
-                    if invoice_line.type != 'line':
-                        continue
-                    tax = invoice_line.ganancias_regimen or default_regimen
-                    if tax.id not in res:
-                        continue
-                    if used_regimen is None:
-                        used_regimen = tax
-                    accumulated_amount = invoice_line.amount * payment_rate
-                    res[tax.id]['accumulated_amount'] += (
-                        accumulated_amount.quantize(quantize))
-            if used_regimen and voucher.lines_debits:
-                for line in voucher.lines_debits:
-                    origin = str(line.move_line.move_origin)
-                    if origin[:origin.find(',')] == 'account.invoice':
-                        invoice = Invoice(line.move_line.move_origin.id)
-                        vat_rate = Decimal(invoice.untaxed_amount /
-                            invoice.total_amount)
-                        accumulated_amount = line.amount_original * vat_rate
-                    else:
-                        accumulated_amount = line.amount_original
-                    res[used_regimen.id]['accumulated_amount'] -= (
-                        accumulated_amount.quantize(quantize))
-
-            if voucher.amount > voucher.amount_to_pay:
-                difference = ((voucher.amount - voucher.amount_to_pay) /
-                    (1 + vat_rate))
-                if default_regimen.id in res:
-                    res[default_regimen.id]['accumulated_amount'] += (
-                        difference.quantize(quantize))
+        for tax_id in res.keys():
+            accumulated_amount, _ = batch.get_ledger_amounts(self, tax_id)
+            res[tax_id]['accumulated_amount'] += accumulated_amount
 
         # Accumulated Withheld
         for tax_id in res.keys():
-            withholdings = TaxWithholdingSubmitted.search([
-                ('tax', '=', tax_id),
-                ('party', '=', self.party),
-                ('date', '>=', period_first_date),
-                ('date', '<=', period_last_date),
-                ('state', '=', 'issued'),
-                ])
-            for withholding in withholdings:
-                res[tax_id]['accumulated_withheld'] += withholding.amount
+            res[tax_id]['accumulated_withheld'] += batch.get_withheld_amount(
+                self, tax_id)
 
         # Rate and extra data
         for tax_id, tax in res.items():
@@ -378,25 +696,27 @@ class AccountVoucher(metaclass=PoolMeta):
         return res
 
     def _get_withholding_extra_data_ganancias(self, tax_data):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
         res = {
             'rate': Decimal(0),
             'scale_non_taxable_amount': Decimal(0),
             'scale_fixed_amount': Decimal(0),
             }
-        regimen = tax_data['tax']
-        if regimen.scales:
+        regimen = WithholdingType.get_snapshot()[tax_data['tax'].id]
+        scales = regimen.scales
+        if scales:
             taxable_amount = (tax_data['payment_amount'] +
                 tax_data['accumulated_amount'] -
-                regimen.minimum_non_taxable_amount)
-            for scale in regimen.scales:
-                if (taxable_amount >= scale.start_amount and
-                        taxable_amount <= scale.end_amount):
-                    res['rate'] = scale.rate
-                    res['scale_non_taxable_amount'] = (
-                        scale.minimum_non_taxable_amount)
-                    res['scale_fixed_amount'] = (
-                        scale.fixed_withholdable_amount)
-                    return res
+                (regimen.minimum_non_taxable_amount or Decimal(0)))
+            scale = scales.lookup(taxable_amount)
+            if scale:
+                res['rate'] = scale.rate
+                res['scale_non_taxable_amount'] = (
+                    scale.minimum_non_taxable_amount)
+                res['scale_fixed_amount'] = (
+                    scale.fixed_withholdable_amount)
+                return res
         if (self.party.ganancias_condition == 'in' or
                 self.party.company_type == 's_de_h'):
             res['rate'] = regimen.rate_registered
@@ -404,60 +724,111 @@ class AccountVoucher(metaclass=PoolMeta):
             res['rate'] = regimen.rate_non_registered
         return res
 
-    def _calculate_withholding_iva(self, context={}):
+    @classmethod
+    def get_withholding_ledger_amounts(cls, vouchers):
+        '''
+        Return the (base, withheld) amounts that the posted payments add to
+        the ledger keyed by (company, party, month, regime)
+        '''
+        vouchers = cls.browse([v.id for v in vouchers])
+        batch = WithholdingBatch(vouchers)
+        res = {}
+        for voucher in vouchers:
+            for key, (base_amount, withheld_amount) in (
+                    voucher._get_withholding_ledger_amounts(batch).items()):
+                res.setdefault(key, (Decimal(0), Decimal(0)))
+                res[key] = (res[key][0] + base_amount,
+                    res[key][1] + withheld_amount)
+        return res
+
+    def _get_withholding_ledger_amounts(self, batch=None):
         pool = Pool()
-        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        Ledger = pool.get('account.retencion.ledger')
+        WithholdingType = pool.get('account.retencion')
+
+        if self.voucher_type != 'payment':
+            return {}
+        if batch is None:
+            batch = WithholdingBatch([self])
 
         quantize = Decimal(10) ** -Decimal(2)
+        res = {}
 
-        withholding_data = self._get_withholding_data_iva(context)
-        for data in withholding_data.values():
+        def add(tax, base_amount=Decimal(0), withheld_amount=Decimal(0)):
+            key = (self.company.id, self.party.id,
+                Ledger.get_month(self.date), tax.id)
+            res.setdefault(key, (Decimal(0), Decimal(0)))
+            res[key] = (res[key][0] + base_amount,
+                res[key][1] + withheld_amount)
 
-            withholding_type = data['tax']
+        default_regimen = self.party.ganancias_regimen
+        if not default_regimen:
+            profile = self.company.get_withholding_profile()
+            if profile.ganancias_regimen_retencion:
+                default_regimen = WithholdingType(
+                    profile.ganancias_regimen_retencion)
 
-            payment_amount = data['payment_amount']
-            accumulated_amount = data['accumulated_amount'] + payment_amount
-            minimum_non_taxable_amount = (
-                withholding_type.minimum_non_taxable_amount or Decimal(0))
-            if accumulated_amount < minimum_non_taxable_amount:
+        # Accumulated Amount
+        vat_rate = Decimal(0.21)
+        used_regimen = None
+        for line in self.lines:
+            invoice = batch.get_invoice(line)
+            if not invoice:
                 continue
-
-            taxable_amount = accumulated_amount - minimum_non_taxable_amount
-            rate = data['rate']
-            if not rate:
+            if not line.amount:
                 continue
 
-            computed_amount = taxable_amount * rate / Decimal(100)
-            computed_amount = computed_amount.quantize(quantize)
+            payment_rate = Decimal(line.amount / invoice.total_amount)
 
-            minimum_withholdable_amount = (
-                withholding_type.minimum_withholdable_amount or Decimal(0))
-            if computed_amount < minimum_withholdable_amount:
-                continue
+            for regime, base_amount in invoice.get_withholding_bases():
+                tax = WithholdingType(regime) if regime else default_regimen
+                if not tax:
+                    continue
+                if used_regimen is None:
+                    used_regimen = tax
+                accumulated_amount = base_amount * payment_rate
+                add(tax, base_amount=accumulated_amount.quantize(quantize))
+        if used_regimen and self.lines_debits:
+            for line in self.lines_debits:
+                invoice = batch.get_invoice(line)
+                if invoice:
+                    vat_rate = Decimal(invoice.untaxed_amount /
+                        invoice.total_amount)
+                    accumulated_amount = line.amount_original * vat_rate
+                else:
+                    accumulated_amount = line.amount_original
+                add(used_regimen,
+                    base_amount=-accumulated_amount.quantize(quantize))
+
+        if default_regimen and self.amount > self.amount_to_pay:
+            difference = ((self.amount - self.amount_to_pay) /
+                (1 + vat_rate))
+            add(default_regimen, base_amount=difference.quantize(quantize))
+
+        # Accumulated Withheld
+        for retencion in self.retenciones_efectuadas:
+            if retencion.state == 'issued' and retencion.tax:
+                add(retencion.tax, withheld_amount=retencion.amount)
+
+        return res
 
-            accumulated_withheld = data['accumulated_withheld']
-            amount = computed_amount - accumulated_withheld
-
-            withholding = TaxWithholdingSubmitted()
-            withholding.tax = withholding_type
-            withholding.voucher = self
-            withholding.party = self.party
-            withholding.date = self.date
-            withholding.payment_amount = payment_amount
-            withholding.accumulated_amount = accumulated_amount
-            withholding.minimum_non_taxable_amount = minimum_non_taxable_amount
-            withholding.taxable_amount = taxable_amount
-            withholding.rate = rate
-            withholding.computed_amount = computed_amount
-            withholding.minimum_withholdable_amount = (
-                minimum_withholdable_amount)
-            withholding.accumulated_withheld = accumulated_withheld
-            withholding.amount = amount
-            withholding.save()
-
-    def _get_withholding_data_iva(self, context={}):
+    @phase('calculate_iva')
+    def _calculate_withholding_iva(self, context={}, batch=None):
+        withholdings = []
+        withholding_data = self._get_withholding_data_iva(context, batch)
+        for data in withholding_data.values():
+            withholding = self._compute_withholding(data)
+            if withholding:
+                withholdings.append(withholding)
+        return withholdings
+
+    @phase('data_iva')
+    def _get_withholding_data_iva(self, context={}, batch=None):
         pool = Pool()
-        Invoice = pool.get('account.invoice')
+        WithholdingType = pool.get('account.retencion')
+
+        if batch is None:
+            batch = WithholdingBatch([self])
 
         # Verify conditions
         if not self.party.iva_condition:
@@ -471,7 +842,10 @@ class AccountVoucher(metaclass=PoolMeta):
 
         default_regimen = self.party.iva_regimen
         if not default_regimen:
-            default_regimen = self.company.iva_regimen_retencion
+            profile = self.company.get_withholding_profile()
+            if profile.iva_regimen_retencion:
+                default_regimen = WithholdingType(
+                    profile.iva_regimen_retencion)
         if not default_regimen:
             return {}
 
@@ -499,8 +873,8 @@ class AccountVoucher(metaclass=PoolMeta):
 
         else:
             for line in self.lines:
-                origin = str(line.move_line.move_origin)
-                if origin[:origin.find(',')] != 'account.invoice':
+                invoice = batch.get_invoice(line)
+                if not invoice:
                     continue
                 if not line.amount:
                     continue
@@ -513,16 +887,14 @@ class AccountVoucher(metaclass=PoolMeta):
                         'accumulated_withheld': Decimal(0),
                         }
 
-                invoice = Invoice(line.move_line.move_origin.id)
                 payment_rate = Decimal(line.amount / invoice.total_amount)
                 payment_amount = invoice.pyafipws_imp_iva * payment_rate
                 res[tax.id]['payment_amount'] += (
                         payment_amount.quantize(quantize))
             if self.lines_debits:
                 for line in self.lines_debits:
-                    origin = str(line.move_line.move_origin)
-                    if origin[:origin.find(',')] == 'account.invoice':
-                        invoice = Invoice(line.move_line.move_origin.id)
+                    invoice = batch.get_invoice(line)
+                    if invoice:
                         vat_rate = Decimal(invoice.untaxed_amount /
                             invoice.total_amount)
                         payment_amount = line.amount_original * vat_rate
@@ -532,13 +904,7 @@ class AccountVoucher(metaclass=PoolMeta):
                         payment_amount.quantize(quantize))
 
         # Verify exemptions
-        taxes = [x for x in res.keys()]
-        for exemption in self.party.exemptions:
-            for tax_id in taxes:
-                reference = 'account.retencion,%s' % str(tax_id)
-                if (str(exemption.tax) == reference and
-                        exemption.end_date >= self.date):
-                    del res[tax_id]
+        self._remove_withholding_exemptions(res)
 
         # Rate and extra data
         for tax_id, tax in res.items():
@@ -547,67 +913,32 @@ class AccountVoucher(metaclass=PoolMeta):
         return res
 
     def _get_withholding_extra_data_iva(self, tax_data):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
         res = {
             'rate': Decimal(0),
             }
-        regimen = tax_data['tax']
+        regimen = WithholdingType.get_snapshot()[tax_data['tax'].id]
         res['rate'] = regimen.rate_registered
         return res
 
-    def _calculate_withholding_iibb(self, context={}):
-        pool = Pool()
-        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
-
-        quantize = Decimal(10) ** -Decimal(2)
-
-        withholding_data = self._get_withholding_data_iibb(context)
+    @phase('calculate_iibb')
+    def _calculate_withholding_iibb(self, context={}, batch=None):
+        withholdings = []
+        withholding_data = self._get_withholding_data_iibb(context, batch)
         for data in withholding_data.values():
+            withholding = self._compute_withholding(data)
+            if withholding:
+                withholdings.append(withholding)
+        return withholdings
 
-            withholding_type = data['tax']
-
-            payment_amount = data['payment_amount']
-            accumulated_amount = data['accumulated_amount'] + payment_amount
-            minimum_non_taxable_amount = (
-                withholding_type.minimum_non_taxable_amount or Decimal(0))
-            if accumulated_amount < minimum_non_taxable_amount:
-                continue
-
-            taxable_amount = accumulated_amount - minimum_non_taxable_amount
-            rate = data['rate']
-            if not rate:
-                continue
-
-            computed_amount = taxable_amount * rate / Decimal(100)
-            computed_amount = computed_amount.quantize(quantize)
-
-            minimum_withholdable_amount = (
-                withholding_type.minimum_withholdable_amount or Decimal(0))
-            if computed_amount < minimum_withholdable_amount:
-                continue
-
-            accumulated_withheld = data['accumulated_withheld']
-            amount = computed_amount - accumulated_withheld
-
-            withholding = TaxWithholdingSubmitted()
-            withholding.tax = withholding_type
-            withholding.voucher = self
-            withholding.party = self.party
-            withholding.date = self.date
-            withholding.payment_amount = payment_amount
-            withholding.accumulated_amount = accumulated_amount
-            withholding.minimum_non_taxable_amount = minimum_non_taxable_amount
-            withholding.taxable_amount = taxable_amount
-            withholding.rate = rate
-            withholding.computed_amount = computed_amount
-            withholding.minimum_withholdable_amount = (
-                minimum_withholdable_amount)
-            withholding.accumulated_withheld = accumulated_withheld
-            withholding.amount = amount
-            withholding.save()
-
-    def _get_withholding_data_iibb(self, context={}):
+    @phase('data_iibb')
+    def _get_withholding_data_iibb(self, context={}, batch=None):
         pool = Pool()
-        Invoice = pool.get('account.invoice')
+        WithholdingType = pool.get('account.retencion')
+
+        if batch is None:
+            batch = WithholdingBatch([self])
 
         # Verify conditions
         if self.party.iva_condition not in ['responsable_inscripto', 'exento']:
@@ -617,11 +948,11 @@ class AccountVoucher(metaclass=PoolMeta):
                 'account_retencion_ar.msg_party_iibb_condition'))
         if self.party.iibb_condition in ['ex', 'rs', 'na', 'cs']:
             return {}
-        company_address = self.company.party.address_get('invoice')
-        if not company_address or not company_address.subdivision:
+        profile = self.company.get_withholding_profile()
+        if not profile.subdivision:
             raise UserError(gettext(
                 'account_retencion_ar.msg_company_subdivision'))
-        company_subdivision = company_address.subdivision
+        snapshot = WithholdingType.get_snapshot()
 
         quantize = Decimal(10) ** -Decimal(2)
         res = {}
@@ -631,9 +962,9 @@ class AccountVoucher(metaclass=PoolMeta):
             amount = context.get('amount', Decimal(0))
             amount_option = context.get('amount_option', 'add')
 
-        for tax in self.company.iibb_regimenes_retencion:
+        for tax in WithholdingType.browse(profile.iibb_regimenes_retencion):
             ok = False
-            if tax.subdivision == company_subdivision:
+            if snapshot[tax.id].subdivision == profile.subdivision:
                 ok = True
             elif self.party.iibb_condition == 'cm':
                 for x in self.party.iibb_regimenes:
@@ -661,8 +992,8 @@ class AccountVoucher(metaclass=PoolMeta):
 
             else:
                 for line in self.lines:
-                    origin = str(line.move_line.move_origin)
-                    if origin[:origin.find(',')] != 'account.invoice':
+                    invoice = batch.get_invoice(line)
+                    if not invoice:
                         continue
                     if not line.amount:
                         continue
@@ -675,7 +1006,6 @@ class AccountVoucher(metaclass=PoolMeta):
                             'accumulated_withheld': Decimal(0),
                             }
 
-                    invoice = Invoice(line.move_line.move_origin.id)
                     if line.amount == invoice.total_amount:
                         payment_amount = invoice.untaxed_amount
                     else:
@@ -685,9 +1015,8 @@ class AccountVoucher(metaclass=PoolMeta):
                         quantize)
                 if self.lines_debits:
                     for line in self.lines_debits:
-                        origin = str(line.move_line.move_origin)
-                        if origin[:origin.find(',')] == 'account.invoice':
-                            invoice = Invoice(line.move_line.move_origin.id)
+                        invoice = batch.get_invoice(line)
+                        if invoice:
                             vat_rate = Decimal(invoice.untaxed_amount /
                                 invoice.total_amount)
                             payment_amount = line.amount_original * vat_rate
@@ -697,13 +1026,7 @@ class AccountVoucher(metaclass=PoolMeta):
                             payment_amount.quantize(quantize))
 
         # Verify exemptions
-        taxes = [x for x in res.keys()]
-        for exemption in self.party.exemptions:
-            for tax_id in taxes:
-                reference = 'account.retencion,%s' % str(tax_id)
-                if (str(exemption.tax) == reference and
-                        exemption.end_date >= self.date):
-                    del res[tax_id]
+        self._remove_withholding_exemptions(res)
 
         # Rate and extra data
         for tax_id, tax in res.items():
@@ -712,14 +1035,23 @@ class AccountVoucher(metaclass=PoolMeta):
         return res
 
     def _get_withholding_extra_data_iibb(self, tax_data):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
+        Padron = pool.get('party.padron.iibb')
         res = {
             'rate': Decimal(0),
             }
-        regimen = tax_data['tax']
+        regimen = WithholdingType.get_snapshot()[tax_data['tax'].id]
         for x in self.party.iibb_regimenes:
-            if x.regimen_retencion == regimen and x.rate_retencion:
+            if (x.regimen_retencion and x.regimen_retencion.id == regimen.id
+                    and x.rate_retencion):
                 res['rate'] = x.rate_retencion
                 return res
+        rate = Padron.get_rate(regimen.subdivision, self.party.vat_number,
+            self.date, 'withholding')
+        if rate is not None:
+            res['rate'] = rate
+            return res
         if self.party.iibb_condition in ['in', 'cm']:
             res['rate'] = regimen.rate_registered
         else:
@@ -768,27 +1100,49 @@ class AccountVoucher(metaclass=PoolMeta):
         pool = Pool()
         TaxWithholdingReceived = pool.get('account.retencion.soportada')
         TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        WithholdingType = pool.get('account.retencion')
+        Ledger = pool.get('account.retencion.ledger')
+        Sequence = pool.get('ir.sequence')
 
         super().post(vouchers)
 
+        snapshot = WithholdingType.get_snapshot()
+        received_args = []
+        to_issue = {}
         for voucher in vouchers:
             if voucher.retenciones_soportadas:
-                TaxWithholdingReceived.write(list(
-                        voucher.retenciones_soportadas), {
-                    'party': voucher.party.id,
-                    'state': 'held',
-                    })
-            if voucher.retenciones_efectuadas:
-                for retencion in voucher.retenciones_efectuadas:
-                    if not retencion.tax.sequence:
-                        raise UserError(gettext(
-                            'account_retencion_ar.msg_missing_retencion_seq'))
-
-                    TaxWithholdingSubmitted.write([retencion], {
+                received_args.extend((list(voucher.retenciones_soportadas), {
                         'party': voucher.party.id,
-                        'name': retencion.tax.sequence.get(),
-                        'state': 'issued',
-                        })
+                        'state': 'held',
+                        }))
+            for retencion in voucher.retenciones_efectuadas:
+                sequence_id = snapshot[retencion.tax.id].get_sequence(
+                    voucher.company)
+                if not sequence_id:
+                    raise UserError(gettext(
+                        'account_retencion_ar.msg_missing_retencion_seq'))
+                to_issue.setdefault(sequence_id, []).append(
+                    (voucher, retencion))
+        if received_args:
+            TaxWithholdingReceived.write(*received_args)
+
+        # Reserve the numbers of each sequence in one step and always in the
+        # same order to not deadlock with concurrent posts
+        submitted_args = []
+        for sequence_id in sorted(to_issue):
+            retenciones = to_issue[sequence_id]
+            names = TaxWithholdingSubmitted.get_sequence_names(
+                Sequence(sequence_id), len(retenciones))
+            for (voucher, retencion), name in zip(retenciones, names):
+                submitted_args.extend(([retencion], {
+                            'party': voucher.party.id,
+                            'name': name,
+                            'state': 'issued',
+                            }))
+        if submitted_args:
+            TaxWithholdingSubmitted.write(*submitted_args)
+        Ledger.add_vouchers([v for v in vouchers
+                if v.voucher_type == 'payment'])
 
     @classmethod
     @ModelView.button
@@ -796,9 +1150,17 @@ class AccountVoucher(metaclass=PoolMeta):
         pool = Pool()
         TaxWithholdingReceived = pool.get('account.retencion.soportada')
         TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+        Ledger = pool.get('account.retencion.ledger')
+
+        ledger_amounts = cls.get_withholding_ledger_amounts([v
+                for v in vouchers
+                if v.voucher_type == 'payment' and v.state == 'posted'])
 
         super().cancel(vouchers)
 
+        Ledger.add_amounts({k: (-b, -w)
+                for k, (b, w) in ledger_amounts.items()})
+
         for voucher in vouchers:
             if voucher.retenciones_soportadas:
                 TaxWithholdingReceived.write(list(
@@ -812,6 +1174,8 @@ class AccountVoucher(metaclass=PoolMeta):
                     'party': None,
                     'state': 'cancelled',
                     })
+        # The reports of closed periods list the issued withholdings
+        ClosedPeriodReportCacheMixin._closed_period_cache.clear()
 
 
 class RecalculateWithholdingsStart(ModelView):
@@ -856,12 +1220,11 @@ class RecalculateWithholdings(Wizard):
 
         voucher = AccountVoucher(Transaction().context['active_id'])
 
-        voucher.delete_withholding()
-        voucher.calculate_withholdings(context={
-            'amount': self.start.amount,
-            'vat_rate': Decimal(0.21),
-            'amount_option': self.start.amount_option,
-            })
+        AccountVoucher.calculate_withholdings_batch([voucher], context={
+                'amount': self.start.amount,
+                'vat_rate': Decimal(0.21),
+                'amount_option': self.start.amount_option,
+                })
         return 'end'
 
     def end(self):
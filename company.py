@@ -2,11 +2,27 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 
+from trytond.cache import Cache
 from trytond.model import ModelSQL, fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 
 
+class WithholdingProfile(object):
+    'Withholding and perception settings of a company'
+    __slots__ = ('ganancias_agente_retencion', 'ganancias_regimen_retencion',
+        'iva_agente_retencion', 'iva_regimen_retencion',
+        'iibb_agente_retencion', 'iibb_regimenes_retencion',
+        'iibb_agente_percepcion', 'iibb_regimenes_percepcion', 'subdivision')
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values[name])
+
+    def __deepcopy__(self, memo):
+        return self
+
+
 class Company(metaclass=PoolMeta):
     __name__ = 'company.company'
 
@@ -36,9 +52,77 @@ class Company(metaclass=PoolMeta):
             ('perception_tax_code', '=', 'iibb'),
             ('group.kind', '=', 'sale'),
             ])
+    _withholding_profile_cache = Cache(
+        'company.company.get_withholding_profile', context=False)
+
+    def get_withholding_profile(self):
+        '''
+        Return the WithholdingProfile of the company with the ids of its
+        regimes and the subdivision of its invoice address
+        '''
+        profile = self._withholding_profile_cache.get(self.id)
+        if profile is not None:
+            return profile
+
+        address = self.party.address_get('invoice')
+        profile = WithholdingProfile(
+            ganancias_agente_retencion=bool(self.ganancias_agente_retencion),
+            ganancias_regimen_retencion=(
+                self.ganancias_regimen_retencion.id
+                if self.ganancias_regimen_retencion else None),
+            iva_agente_retencion=bool(self.iva_agente_retencion),
+            iva_regimen_retencion=(self.iva_regimen_retencion.id
+                if self.iva_regimen_retencion else None),
+            iibb_agente_retencion=bool(self.iibb_agente_retencion),
+            iibb_regimenes_retencion=tuple(
+                r.id for r in self.iibb_regimenes_retencion),
+            iibb_agente_percepcion=bool(self.iibb_agente_percepcion),
+            iibb_regimenes_percepcion=tuple(
+                r.id for r in self.iibb_regimenes_percepcion),
+            subdivision=(address.subdivision.id
+                if address and address.subdivision else None))
+        self._withholding_profile_cache.set(self.id, profile)
+        return profile
+
+    @classmethod
+    def create(cls, vlist):
+        companies = super().create(vlist)
+        cls._withholding_profile_cache.clear()
+        return companies
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._withholding_profile_cache.clear()
+
+    @classmethod
+    def delete(cls, companies):
+        super().delete(companies)
+        cls._withholding_profile_cache.clear()
+
+
+class ClearWithholdingProfileMixin(object):
+    'Clear the withholding profiles of the companies on any change'
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        Pool().get('company.company')._withholding_profile_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Pool().get('company.company')._withholding_profile_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        Pool().get('company.company')._withholding_profile_cache.clear()
 
 
-class CompanyWithholdingIIBB(ModelSQL):
+class CompanyWithholdingIIBB(ClearWithholdingProfileMixin, ModelSQL):
     'Régimen de Ingresos Brutos de Empresa'
     __name__ = 'company.retencion.iibb'
 
@@ -49,7 +133,7 @@ class CompanyWithholdingIIBB(ModelSQL):
         context={'company': Eval('company', -1)}, depends={'company'})
 
 
-class CompanyPerceptionIIBB(ModelSQL):
+class CompanyPerceptionIIBB(ClearWithholdingProfileMixin, ModelSQL):
     'Régimen de Ingresos Brutos de Empresa'
     __name__ = 'company.percepcion.iibb'
 
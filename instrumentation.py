@@ -0,0 +1,195 @@
+# This file is part of the account_retencion_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Instrumentation of the withholding calculation.
+
+It is enabled when the logger of this module is enabled for DEBUG or when a
+listener is registered with add_listener. The summary of each profile is
+then logged and passed as a dictionary to the listeners.
+'''
+import functools
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from trytond.transaction import Transaction
+
+__all__ = ['add_listener', 'remove_listener', 'is_enabled', 'profile',
+    'phase']
+
+logger = logging.getLogger(__name__)
+_listeners = []
+_local = threading.local()
+
+
+def add_listener(listener):
+    'Register a callable receiving the summary of each profile'
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+def is_enabled():
+    return bool(_listeners) or logger.isEnabledFor(logging.DEBUG)
+
+
+class QueryCounter(object):
+    'Count the SQL queries executed on a connection'
+    __slots__ = ('count', '_restore')
+
+    def __init__(self, connection):
+        self.count = 0
+        self._restore = None
+        if hasattr(connection, 'set_trace_callback'):
+            # SQLite
+            connection.set_trace_callback(self._trace)
+            self._restore = functools.partial(
+                self._restore_trace, connection)
+        elif hasattr(connection, 'cursor_factory'):
+            # PostgreSQL
+            cursor_factory = connection.cursor_factory
+            counter = self
+
+            class CountingCursor(cursor_factory):
+                def execute(self, *args, **kwargs):
+                    counter.count += 1
+                    return super().execute(*args, **kwargs)
+
+                def executemany(self, *args, **kwargs):
+                    counter.count += 1
+                    return super().executemany(*args, **kwargs)
+
+            connection.cursor_factory = CountingCursor
+            self._restore = functools.partial(
+                setattr, connection, 'cursor_factory', cursor_factory)
+
+    def _trace(self, statement):
+        self.count += 1
+        backend_logger = logging.getLogger('trytond.backend.sqlite.database')
+        if backend_logger.isEnabledFor(logging.DEBUG):
+            backend_logger.debug(statement)
+
+    @staticmethod
+    def _restore_trace(connection):
+        backend_logger = logging.getLogger('trytond.backend.sqlite.database')
+        if backend_logger.isEnabledFor(logging.DEBUG):
+            connection.set_trace_callback(backend_logger.debug)
+        else:
+            connection.set_trace_callback(None)
+
+    def close(self):
+        if self._restore:
+            self._restore()
+            self._restore = None
+
+
+class PhaseStats(object):
+    'Wall time and SQL queries of a phase'
+    __slots__ = ('name', 'level', 'duration', 'queries')
+
+    def __init__(self, name, level):
+        self.name = name
+        self.level = level
+        self.duration = 0.
+        self.queries = 0
+
+    def as_dict(self):
+        return {n: getattr(self, n) for n in self.__slots__}
+
+
+class Profile(object):
+    'Phases of a profiled calculation'
+
+    def __init__(self, name, counter, **info):
+        self.name = name
+        self.info = info
+        self.phases = []
+        self._counter = counter
+        self._level = 0
+
+    @contextmanager
+    def phase(self, name):
+        stats = PhaseStats(name, self._level)
+        self.phases.append(stats)
+        self._level += 1
+        queries = self._counter.count
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.duration = time.perf_counter() - start
+            stats.queries = self._counter.count - queries
+            self._level -= 1
+
+    def as_dict(self):
+        summary = {
+            'name': self.name,
+            'phases': [p.as_dict() for p in self.phases],
+            }
+        summary.update(self.info)
+        return summary
+
+    def __str__(self):
+        lines = ['%s %s' % (self.name, ' '.join(
+                    '%s=%s' % i for i in sorted(self.info.items())))]
+        for stats in self.phases:
+            lines.append('%s%s: %.6fs %s queries' % (
+                    '  ' * (stats.level + 1), stats.name, stats.duration,
+                    stats.queries))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profile(name, **info):
+    '''
+    Profile the calculation inside the context.
+    The phases called in the context are recorded on it.
+    '''
+    if not is_enabled():
+        yield None
+        return
+
+    profiles = getattr(_local, 'profiles', None)
+    if profiles is None:
+        profiles = _local.profiles = []
+    parent = profiles[-1] if profiles else None
+    if parent:
+        counter = parent._counter
+    else:
+        counter = QueryCounter(Transaction().connection)
+    current = Profile(name, counter, **info)
+    with ExitStack() as stack:
+        if parent:
+            # Record the nested profile also as a phase of its parent
+            stack.enter_context(parent.phase(name))
+        profiles.append(current)
+        try:
+            with current.phase(name):
+                yield current
+        finally:
+            profiles.pop()
+            if not parent:
+                counter.close()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('%s', current)
+            summary = current.as_dict()
+            for listener in list(_listeners):
+                listener(summary)
+
+
+def phase(name):
+    'Decorate a function to record it as a phase of the current profile'
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiles = getattr(_local, 'profiles', None)
+            if not profiles:
+                return func(*args, **kwargs)
+            with profiles[-1].phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -3,16 +3,159 @@
 # the full copyright notices and license terms.
 from decimal import Decimal
 
-from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.cache import Cache
+from trytond.model import ModelSQL, dualmethod, fields
+from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.tools import grouped_slice
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
+from .account_retencion_ar import ClosedPeriodReportCacheMixin
+
+M_TYPES = ['051', '052', '053', '054', '118', '119', '120']
+
 
 class Invoice(metaclass=PoolMeta):
     __name__ = 'account.invoice'
 
+    withholding_m_type = fields.Boolean('Withholding M Type', readonly=True)
+    withholding_bases = fields.One2Many('account.invoice.withholding_base',
+        'invoice', 'Withholding Bases', readonly=True)
+    _perception_data_cache = Cache(
+        'account.invoice.get_perception_data_iibb', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._check_modify_exclude |= {
+            'withholding_m_type', 'withholding_bases'}
+
+    @classmethod
+    def copy(cls, invoices, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('withholding_m_type', False)
+        default.setdefault('withholding_bases', None)
+        return super().copy(invoices, default=default)
+
+    @classmethod
+    def _post(cls, invoices):
+        super()._post(invoices)
+        cls.set_withholding_summary([i for i in invoices if i.type == 'in'])
+
+    @classmethod
+    def cancel(cls, invoices):
+        super().cancel(invoices)
+        # The reports of closed periods list the perceptions by invoice state
+        ClosedPeriodReportCacheMixin._closed_period_cache.clear()
+
+    @classmethod
+    def set_withholding_summary(cls, invoices):
+        '''
+        Store on the supplier invoices the summary read by the withholding
+        calculation of the payments
+        '''
+        pool = Pool()
+        WithholdingBase = pool.get('account.invoice.withholding_base')
+
+        if not invoices:
+            return
+        WithholdingBase.delete(WithholdingBase.search([
+                    ('invoice', 'in', [i.id for i in invoices]),
+                    ]))
+        to_create = []
+        m_types, others = [], []
+        for invoice in invoices:
+            for sequence, (regime, amount) in enumerate(
+                    invoice._compute_withholding_bases()):
+                to_create.append({
+                        'invoice': invoice.id,
+                        'sequence': sequence,
+                        'regime': regime,
+                        'amount': amount,
+                        })
+            if invoice.tipo_comprobante in M_TYPES:
+                m_types.append(invoice)
+            else:
+                others.append(invoice)
+        WithholdingBase.create(to_create)
+        to_write = []
+        if m_types:
+            to_write.extend((m_types, {'withholding_m_type': True}))
+        if others:
+            to_write.extend((others, {'withholding_m_type': False}))
+        if to_write:
+            cls.write(*to_write)
+
+    def _compute_withholding_bases(self):
+        '''
+        Return the Ganancias regime id and untaxed amount of each line.
+        The lines are kept apart as the payment share is quantized by line.
+        '''
+        return [(line.ganancias_regimen.id if line.ganancias_regimen else None,
+                line.amount)
+            for line in self.lines if line.type == 'line']
+
+    def get_withholding_bases(self):
+        '''
+        Return the list of Ganancias regime id (None for the default regime)
+        and untaxed amount of each line in the order of the lines
+        '''
+        if self.withholding_bases:
+            return [(b.regime.id if b.regime else None, b.amount)
+                for b in self.withholding_bases]
+        # Invoices posted before the summary was stored
+        return self._compute_withholding_bases()
+
+    def is_withholding_m_type(self):
+        if self.withholding_bases:
+            return self.withholding_m_type
+        return self.tipo_comprobante in M_TYPES
+
+    @dualmethod
+    def update_taxes(cls, invoices, exception=False):
+        for sub_invoices in grouped_slice(invoices):
+            sub_invoices = list(sub_invoices)
+            cls._load_perception_data(sub_invoices)
+            try:
+                super().update_taxes(sub_invoices, exception=exception)
+            finally:
+                for invoice in sub_invoices:
+                    invoice._perception_data_iibb = None
+
+    @classmethod
+    def _load_perception_data(cls, invoices):
+        '''
+        Resolve the IIBB perception data once for each group of customer
+        invoices sharing the party and the tax date and set it on the
+        invoices for the computation of their taxes
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        PartyExemption = pool.get('party.exemption')
+
+        invoices = [i for i in invoices
+            if i.type == 'out'
+            and i.state not in {'posted', 'paid', 'cancelled'}
+            and i.company.get_withholding_profile().iibb_agente_percepcion
+            and i._get_perception_untaxed_amount()]
+        if not invoices:
+            return
+        PartyExemption.get_exemptions(
+            Party.browse({i.party.id for i in invoices}))
+
+        groups = {}
+        for invoice in invoices:
+            groups.setdefault(
+                invoice._get_perception_data_key(), []).append(invoice)
+        for invoices in groups.values():
+            data = invoices[0]._get_perception_data_iibb()
+            for invoice in invoices:
+                invoice._perception_data_iibb = data
+
     @fields.depends('type')
     def _get_taxes(self):
         taxes = super()._get_taxes()
@@ -22,19 +165,23 @@ class Invoice(metaclass=PoolMeta):
 
     def _get_perceptions(self):
         taxes = {}
-        if self.company.iibb_agente_percepcion:
+        if self.company.get_withholding_profile().iibb_agente_percepcion:
             taxes.update(self._get_perception_iibb())
         return taxes
 
+    def _get_perception_untaxed_amount(self):
+        untaxed_amount = Decimal(0)
+        if self.lines:
+            for line in self.lines:
+                untaxed_amount += getattr(line, 'amount', None) or 0
+        return untaxed_amount
+
     def _get_perception_iibb(self):
         taxes = {}
         quantize = Decimal(10) ** -Decimal(2)
         factor = 1
 
-        untaxed_amount = Decimal(0)
-        if self.lines:
-            for line in self.lines:
-                untaxed_amount += getattr(line, 'amount', None) or 0
+        untaxed_amount = self._get_perception_untaxed_amount()
         if not untaxed_amount:
             return taxes
 
@@ -76,7 +223,43 @@ class Invoice(metaclass=PoolMeta):
 
         return taxes
 
+    def _get_perception_data_key(self):
+        'Return the key of the perception data of the invoice'
+        profile = self.company.get_withholding_profile()
+        # The CUIT is stored on the party identifiers
+        return (self.company.id, self.party.id, self.tax_date,
+            self.party.write_date, self.party.vat_number,
+            tuple((r.id, r.write_date) for r in self.party.iibb_regimenes),
+            profile.iibb_regimenes_percepcion, profile.subdivision)
+
     def _get_perception_data_iibb(self):
+        pool = Pool()
+        Tax = pool.get('account.tax')
+
+        # Loaded by update_taxes for the invoices sharing the same data
+        loaded = getattr(self, '_perception_data_iibb', None)
+        if loaded is not None:
+            return loaded
+
+        key = self._get_perception_data_key()
+        data = self._perception_data_cache.get(key)
+        if data is None:
+            data = {}
+            for tax_id, values in self._resolve_perception_data_iibb().items():
+                values = values.copy()
+                del values['tax']
+                data[tax_id] = values
+            self._perception_data_cache.set(key, data)
+
+        res = {}
+        for tax in Tax.browse(list(data.keys())):
+            res[tax.id] = dict(data[tax.id], tax=tax)
+        return res
+
+    def _resolve_perception_data_iibb(self):
+        pool = Pool()
+        Tax = pool.get('account.tax')
+
         # Verify conditions
         if self.party.iva_condition not in ['responsable_inscripto', 'exento']:
             return {}
@@ -85,16 +268,15 @@ class Invoice(metaclass=PoolMeta):
                 'account_retencion_ar.msg_party_iibb_condition'))
         if self.party.iibb_condition in ['ex', 'rs', 'na', 'cs']:
             return {}
-        company_address = self.company.party.address_get('invoice')
-        if not company_address or not company_address.subdivision:
+        profile = self.company.get_withholding_profile()
+        if not profile.subdivision:
             raise UserError(gettext(
                 'account_retencion_ar.msg_company_subdivision'))
-        company_subdivision = company_address.subdivision
 
         res = {}
-        for tax in self.company.iibb_regimenes_percepcion:
+        for tax in Tax.browse(profile.iibb_regimenes_percepcion):
             ok = False
-            if tax.subdivision == company_subdivision:
+            if tax.subdivision and tax.subdivision.id == profile.subdivision:
                 ok = True
             elif self.party.iibb_condition == 'cm':
                 for x in self.party.iibb_regimenes:
@@ -107,13 +289,9 @@ class Invoice(metaclass=PoolMeta):
                 }
 
         # Verify exemptions
-        taxes = [x for x in res.keys()]
-        for exemption in self.party.exemptions:
-            for tax_id in taxes:
-                reference = 'account.tax,%s' % str(tax_id)
-                if (str(exemption.tax) == reference and
-                        exemption.end_date >= self.tax_date):
-                    del res[tax_id]
+        for tax_id in list(res.keys()):
+            if self.party.is_exempt(res[tax_id]['tax'], self.tax_date):
+                del res[tax_id]
 
         # Rate and extra data
         for tax_id, tax in res.items():
@@ -122,6 +300,8 @@ class Invoice(metaclass=PoolMeta):
         return res
 
     def _get_perception_extra_data_iibb(self, tax_data):
+        pool = Pool()
+        Padron = pool.get('party.padron.iibb')
         res = {
             'rate': Decimal(0),
             }
@@ -130,6 +310,12 @@ class Invoice(metaclass=PoolMeta):
             if x.regimen_percepcion == regimen and x.rate_percepcion:
                 res['rate'] = x.rate_percepcion
                 return res
+        rate = Padron.get_rate(
+            regimen.subdivision.id if regimen.subdivision else None,
+            self.party.vat_number, self.tax_date, 'perception')
+        if rate is not None:
+            res['rate'] = rate
+            return res
         if self.party.iibb_condition in ['in', 'cm']:
             res['rate'] = regimen.rate_registered
         else:
@@ -137,6 +323,23 @@ class Invoice(metaclass=PoolMeta):
         return res
 
 
+class InvoiceWithholdingBase(ModelSQL):
+    'Invoice Withholding Base'
+    __name__ = 'account.invoice.withholding_base'
+
+    invoice = fields.Many2One('account.invoice', 'Invoice', required=True,
+        ondelete='CASCADE')
+    sequence = fields.Integer('Sequence')
+    regime = fields.Many2One('account.retencion', 'Regime',
+        ondelete='CASCADE')
+    amount = fields.Numeric('Amount', digits=(16, 2), required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('sequence', 'ASC'))
+
+
 class InvoiceLine(metaclass=PoolMeta):
     __name__ = 'account.invoice.line'
 
@@ -0,0 +1,378 @@
+# This file is part of the account_retencion_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime as dt
+import io
+import os
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from trytond.cache import Cache
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model import Index, ModelSQL, ModelView, Workflow, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+from trytond.wizard import Button, StateTransition, StateView, Wizard
+
+from .account_retencion_ar import ClosedPeriodReportCacheMixin
+
+# Rows loaded by statement
+_BULK_SIZE = 10000
+
+
+def _parse_date(value):
+    return dt.datetime.strptime(value.strip(), '%d%m%Y').date()
+
+
+def _parse_rate(value):
+    return Decimal(value.strip().replace(',', '.'))
+
+
+def parse_arba(lines):
+    '''
+    Yield the (start date, end date, CUIT, kind, rate) of a padrón of ARBA
+    (Buenos Aires) with the lines:
+    Régimen;Publicación;Desde;Hasta;CUIT;Tipo;Alta;Cambio;Alícuota;Grupo
+    '''
+    kinds = {'P': 'perception', 'R': 'withholding'}
+    for line in lines:
+        values = line.split(';')
+        if len(values) < 9 or values[0] not in kinds:
+            continue
+        yield (_parse_date(values[2]), _parse_date(values[3]),
+            values[4].strip(), kinds[values[0]], _parse_rate(values[8]))
+
+
+def parse_agip(lines):
+    '''
+    Yield the (start date, end date, CUIT, kind, rate) of a padrón of AGIP
+    (Ciudad de Buenos Aires) with the lines:
+    Publicación;Desde;Hasta;CUIT;Tipo;Alta;Cambio;Alícuota Percepción;
+    Alícuota Retención;Grupo Percepción;Grupo Retención;Razón Social
+    '''
+    for line in lines:
+        values = line.split(';')
+        if len(values) < 9:
+            continue
+        start_date = _parse_date(values[1])
+        end_date = _parse_date(values[2])
+        vat_number = values[3].strip()
+        yield (start_date, end_date, vat_number, 'perception',
+            _parse_rate(values[7]))
+        yield (start_date, end_date, vat_number, 'withholding',
+            _parse_rate(values[8]))
+
+
+PARSERS = {
+    'arba': parse_arba,
+    'agip': parse_agip,
+    }
+
+
+class PadronIIBB(Workflow, ModelSQL, ModelView):
+    'Padrón de Ingresos Brutos'
+    __name__ = 'party.padron.iibb'
+
+    _states = {
+        'readonly': Eval('state') != 'draft',
+        }
+
+    subdivision = fields.Many2One('country.subdivision', 'Subdivision',
+        required=True, domain=[('country.code', '=', 'AR')], states=_states)
+    start_date = fields.Date('Start Date', required=True, states=_states)
+    end_date = fields.Date('End Date', required=True, states=_states)
+    format = fields.Selection([
+            ('arba', 'ARBA'),
+            ('agip', 'AGIP'),
+            ], 'Format', required=True, states=_states)
+    filename = fields.Char('File Name', readonly=True)
+    state = fields.Selection([
+            ('draft', 'Draft'),
+            ('active', 'Active'),
+            ('replaced', 'Replaced'),
+            ], 'State', readonly=True, required=True)
+    _rates_cache = Cache('party.padron.iibb.get_rates', context=False)
+
+    del _states
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('start_date', 'DESC'))
+        cls._transitions |= set((
+                ('draft', 'active'),
+                ('active', 'replaced'),
+                ))
+        cls._buttons.update({
+                'activate': {
+                    'invisible': Eval('state') != 'draft',
+                    'depends': ['state'],
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('active')
+    def activate(cls, padrones):
+        'Swap in the padrones replacing the active ones of their periods'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        to_replace = set()
+        for padron in padrones:
+            to_replace.update(cls.search([
+                        ('subdivision', '=', padron.subdivision.id),
+                        ('state', '=', 'active'),
+                        ('start_date', '<=', padron.end_date),
+                        ('end_date', '>=', padron.start_date),
+                        ('id', 'not in', [p.id for p in padrones]),
+                        ]))
+        cls.replace(list(to_replace))
+        Invoice._perception_data_cache.clear()
+
+    @classmethod
+    @Workflow.transition('replaced')
+    def replace(cls, padrones):
+        pass
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._rates_cache.clear()
+
+    @classmethod
+    def delete(cls, padrones):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        Line = pool.get('party.padron.iibb.line')
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cls.check_delete(padrones)
+        # The lines are deleted in SQL as they are too many for the ORM
+        for sub_ids in grouped_slice([p.id for p in padrones]):
+            cursor.execute(*line.delete(
+                    where=reduce_ids(line.padron, sub_ids)))
+        super().delete(padrones)
+        cls._rates_cache.clear()
+        Invoice._perception_data_cache.clear()
+        ClosedPeriodReportCacheMixin._closed_period_cache.clear()
+
+    @classmethod
+    def check_delete(cls, padrones):
+        for padron in padrones:
+            if padron.state == 'active':
+                raise UserError(gettext(
+                        'account_retencion_ar.msg_padron_delete_active',
+                        subdivision=padron.subdivision.rec_name,
+                        start_date=padron.start_date,
+                        end_date=padron.end_date))
+
+    @classmethod
+    def import_file(cls, file, subdivision, format, filename=None,
+            activate=True):
+        '''
+        Import the padrón from the binary file object in a new padrón of the
+        subdivision and activate it.
+        The file is read line by line and loaded by chunks of rows.
+        '''
+        pool = Pool()
+        Line = pool.get('party.padron.iibb.line')
+
+        lines = io.TextIOWrapper(file, encoding='latin-1', newline=None)
+        rows = PARSERS[format](lines)
+        try:
+            first = next(rows, None)
+            if first is None:
+                raise UserError(gettext(
+                        'account_retencion_ar.msg_padron_empty',
+                        filename=filename or ''))
+
+            padron = cls(subdivision=subdivision, format=format,
+                filename=filename, start_date=first[0], end_date=first[1])
+            padron.save()
+
+            dates = [first[0], first[1]]
+
+            def track(rows):
+                for row in rows:
+                    dates[0] = min(dates[0], row[0])
+                    dates[1] = max(dates[1], row[1])
+                    yield row
+
+            Line.bulk_load(padron, track(_chain(first, rows)))
+        except (ValueError, InvalidOperation, IndexError) as exception:
+            raise UserError(gettext(
+                    'account_retencion_ar.msg_padron_invalid',
+                    filename=filename or '',
+                    error=exception)) from exception
+        finally:
+            lines.detach()
+
+        if (padron.start_date, padron.end_date) != tuple(dates):
+            padron.start_date, padron.end_date = dates
+            padron.save()
+        if activate:
+            cls.activate([padron])
+        return padron
+
+    @classmethod
+    def import_path(cls, path, subdivision, format, activate=True):
+        '''
+        Import the padrón from the file at path on the server like
+        import_file.
+        It avoids sending the large files through the Import Padrón wizard.
+        '''
+        with open(path, 'rb') as file:
+            return cls.import_file(file, subdivision, format,
+                filename=os.path.basename(path), activate=activate)
+
+    @classmethod
+    def get_rate(cls, subdivision, vat_number, date, kind):
+        '''
+        Return the rate of the kind for the CUIT in the active padrón of the
+        subdivision at the date or None
+        '''
+        if not subdivision or not vat_number or not date:
+            return None
+        return cls.get_rates(subdivision, vat_number, date).get(kind)
+
+    @classmethod
+    def get_rates(cls, subdivision, vat_number, date):
+        '''
+        Return the rates by kind for the CUIT in the active padrón of the
+        subdivision at the date.
+        The CUITs missing in the padrón are also cached.
+        '''
+        pool = Pool()
+        Line = pool.get('party.padron.iibb.line')
+        cursor = Transaction().connection.cursor()
+        padron = cls.__table__()
+        line = Line.__table__()
+
+        key = (int(subdivision), vat_number, date)
+        rates = cls._rates_cache.get(key)
+        if rates is not None:
+            return rates
+
+        rates = {}
+        cursor.execute(*line.join(padron,
+                condition=line.padron == padron.id
+                ).select(line.kind, line.rate,
+                where=(padron.subdivision == int(subdivision))
+                & (padron.state == 'active')
+                & (padron.start_date <= date)
+                & (padron.end_date >= date)
+                & (line.vat_number == vat_number),
+                order_by=[padron.start_date.desc, line.id.desc]))
+        for kind, rate in cursor:
+            rates.setdefault(kind, rate)
+        cls._rates_cache.set(key, rates)
+        return rates
+
+
+def _chain(first, rows):
+    yield first
+    yield from rows
+
+
+class PadronIIBBLine(ModelSQL):
+    'Línea de Padrón de Ingresos Brutos'
+    __name__ = 'party.padron.iibb.line'
+
+    padron = fields.Many2One('party.padron.iibb', 'Padrón', required=True,
+        ondelete='CASCADE')
+    vat_number = fields.Char('CUIT', required=True)
+    kind = fields.Selection([
+            ('perception', 'Perception'),
+            ('withholding', 'Withholding'),
+            ], 'Kind', required=True)
+    rate = fields.Numeric('Rate', digits=(14, 10), required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.vat_number, Index.Equality()),
+                    (t.kind, Index.Equality()),
+                    (t.padron, Index.Equality())),
+                })
+
+    @classmethod
+    def bulk_load(cls, padron, rows):
+        '''
+        Insert the (start date, end date, CUIT, kind, rate) rows in the
+        padrón using COPY on PostgreSQL and executemany otherwise
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        columns = [table.padron, table.vat_number, table.kind, table.rate,
+            table.create_uid, table.create_date]
+        user = transaction.user
+        now = dt.datetime.now()
+
+        rows = ((padron.id, vat_number, kind, rate, user, now)
+            for _, _, vat_number, kind, rate in rows)
+        if hasattr(cursor, 'copy_expert'):
+            copy = 'COPY "%s" (%s) FROM STDIN' % (cls._table,
+                ', '.join('"%s"' % c.name for c in columns))
+            while True:
+                chunk = list(islice(rows, _BULK_SIZE))
+                if not chunk:
+                    break
+                data = io.StringIO(''.join(
+                        '\t'.join(map(str, row)) + '\n' for row in chunk))
+                cursor.copy_expert(copy, data)
+        else:
+            query, _ = tuple(table.insert(columns, [[0] * len(columns)]))
+            while True:
+                chunk = list(islice(rows, _BULK_SIZE))
+                if not chunk:
+                    break
+                cursor.executemany(query, chunk)
+
+
+class ImportPadronIIBBStart(ModelView):
+    'Importar Padrón de Ingresos Brutos'
+    __name__ = 'party.padron.iibb.import.start'
+
+    subdivision = fields.Many2One('country.subdivision', 'Subdivision',
+        required=True, domain=[('country.code', '=', 'AR')])
+    format = fields.Selection([
+            ('arba', 'ARBA'),
+            ('agip', 'AGIP'),
+            ], 'Format', required=True)
+    file_ = fields.Binary('File', required=True, filename='filename')
+    filename = fields.Char('File Name')
+
+
+class ImportPadronIIBB(Wizard):
+    'Importar Padrón de Ingresos Brutos'
+    __name__ = 'party.padron.iibb.import'
+
+    start = StateView('party.padron.iibb.import.start',
+        'account_retencion_ar.padron_iibb_import_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+
+    def transition_import_(self):
+        pool = Pool()
+        Padron = pool.get('party.padron.iibb')
+
+        Padron.import_file(io.BytesIO(self.start.file_),
+            self.start.subdivision, self.start.format,
+            filename=self.start.filename)
+        return 'end'
@@ -2,11 +2,38 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 
+from trytond.cache import Cache
 from trytond.model import ModelSQL, ModelView, fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 
+from .account_retencion_ar import ClosedPeriodReportCacheMixin
+from .company import ClearWithholdingProfileMixin
 
-class Party(metaclass=PoolMeta):
+
+class ClearReportCacheMixin(object):
+    'Clear the cached reports showing the names and CUITs of the parties'
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        ClosedPeriodReportCacheMixin._closed_period_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        ClosedPeriodReportCacheMixin._closed_period_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        ClosedPeriodReportCacheMixin._closed_period_cache.clear()
+
+
+class Party(ClearReportCacheMixin, metaclass=PoolMeta):
     __name__ = 'party.party'
 
     exemptions = fields.One2Many('party.exemption',
@@ -20,6 +47,23 @@ class Party(metaclass=PoolMeta):
     iibb_regimenes = fields.One2Many('party.retencion.iibb',
         'party', 'Jurisdicciones de Ingresos Brutos')
 
+    def is_exempt(self, tax, date):
+        'Return if the party is exempted of the withholding or perception tax'
+        pool = Pool()
+        PartyExemption = pool.get('party.exemption')
+
+        exemptions = PartyExemption.get_exemptions([self])[self.id]
+        end_date = exemptions.get((tax.__name__, tax.id))
+        return bool(end_date and end_date >= date)
+
+
+class Identifier(ClearReportCacheMixin, metaclass=PoolMeta):
+    __name__ = 'party.identifier'
+
+
+class Address(ClearWithholdingProfileMixin, metaclass=PoolMeta):
+    __name__ = 'party.address'
+
 
 class PartyExemption(ModelSQL, ModelView):
     'Exención de Retención/Percepción de Tercero'
@@ -43,6 +87,58 @@ class PartyExemption(ModelSQL, ModelView):
                 ],
             })
     end_date = fields.Date('Valid until', required=True)
+    _exemptions_cache = Cache('party.exemption.get_exemptions', context=False)
+
+    @classmethod
+    def get_exemptions(cls, parties):
+        '''
+        Return for each party the last valid date of its exemptions keyed by
+        the (model, id) of the tax
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        res, missing = {}, []
+        for party_id in {int(p) for p in parties}:
+            exemptions = cls._exemptions_cache.get(party_id)
+            if exemptions is None:
+                missing.append(party_id)
+                res[party_id] = {}
+            else:
+                res[party_id] = exemptions
+
+        for sub_ids in grouped_slice(missing):
+            cursor.execute(*table.select(
+                    table.party, table.tax, table.end_date,
+                    where=reduce_ids(table.party, sub_ids)))
+            for party_id, tax, end_date in cursor:
+                model, tax_id = tax.split(',')
+                key = (model, int(tax_id))
+                exemptions = res[party_id]
+                if key not in exemptions or exemptions[key] < end_date:
+                    exemptions[key] = end_date
+        for party_id in missing:
+            cls._exemptions_cache.set(party_id, res[party_id])
+        return res
+
+    @classmethod
+    def create(cls, vlist):
+        exemptions = super().create(vlist)
+        cls._exemptions_cache.clear()
+        Pool().get('account.invoice')._perception_data_cache.clear()
+        return exemptions
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._exemptions_cache.clear()
+        Pool().get('account.invoice')._perception_data_cache.clear()
+
+    @classmethod
+    def delete(cls, exemptions):
+        super().delete(exemptions)
+        cls._exemptions_cache.clear()
+        Pool().get('account.invoice')._perception_data_cache.clear()
 
 
 class PartyWithholdingIIBB(ModelSQL, ModelView):
@@ -63,3 +159,19 @@ class PartyWithholdingIIBB(ModelSQL, ModelView):
             ('group.kind', '=', 'sale'),
             ])
     rate_percepcion = fields.Numeric('% Percepción', digits=(14, 10))
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        Pool().get('party.padron.iibb')._rates_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Pool().get('party.padron.iibb')._rates_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        Pool().get('party.padron.iibb')._rates_cache.clear()
@@ -112,22 +112,28 @@ class SICORE(object):
         text = separator.join(fields) + self._EOL
         return text
 
+    def _get_tax(self, retencion):
+        pool = Pool()
+        WithholdingType = pool.get('account.retencion')
+        return WithholdingType.get_snapshot()[retencion.tax.id].tax
+
     def get_codigo_impuesto(self, retencion):
         selection = {
             'gana': 217,  # Impuesto a las Ganancias
             'bien': 219,  # Impuesto sobre Bienes Personales
             'iva': 767,   # Impuesto al Valor Agregado
             }
-        return selection[retencion.tax.tax]
+        return selection[self._get_tax(retencion)]
 
     def get_condicion(self, retencion):
-        if retencion.tax.tax == 'gana':
+        tax = self._get_tax(retencion)
+        if tax == 'gana':
             if retencion.party.ganancias_condition == 'in':
                 return '01'
             return '02'
-        if retencion.tax.tax == 'iva':
+        if tax == 'iva':
             return retencion.party.iva_inscripto and '01' or '02'
-        if retencion.tax.tax == 'bien':
+        if tax == 'bien':
             return retencion.party.bienes_inscripto and '01' or '02'
         return '00'
 
@@ -0,0 +1,346 @@
+# This file is part of the account_retencion_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Benchmark of the withholding calculation.
+
+It generates a synthetic dataset for each size and times the calculation,
+the recalculation and the posting of the payments of a month. The database
+is the one of the tests (TRYTOND_DATABASE_URI and DB_NAME), so it runs on
+SQLite and on PostgreSQL:
+
+    python -m trytond.modules.account_retencion_ar.tests.benchmark \\
+        --size 10 --size 100 --output benchmark.json
+'''
+import argparse
+import datetime as dt
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+from stdnum.ar import cuit
+
+from proteus import Model, Wizard
+from trytond import __version__ as trytond_version
+from trytond.config import config as trytond_config
+from trytond.tests.tools import activate_modules
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear)
+from trytond.modules.account_ar.tests.tools import get_accounts
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.account_voucher_ar.tests.tools import (
+    set_fiscalyear_voucher_sequences)
+from trytond.modules.company.tests.tools import create_company
+from trytond.modules.currency.tests.tools import get_currency
+
+from .tools import create_retencion_sequence
+
+__all__ = ['generate_dataset', 'run_benchmark']
+
+IVA_CONDITIONS = ['responsable_inscripto', 'exento']
+GANANCIAS_CONDITIONS = ['in', 'in', 'ex']
+IIBB_CONDITIONS = ['in', 'in', 'cm', 'ex']
+
+# Indexes of the CUITs, unique for all the datasets of the database
+_vat_indexes = itertools.count(1)
+
+
+def _vat_number(index):
+    number = '30%08d' % index
+    return number + cuit.calc_check_digit(number)
+
+
+def _get_subdivision():
+    Country = Model.get('country.country')
+    Subdivision = Model.get('country.subdivision')
+
+    countries = Country.find([('code', '=', 'AR')])
+    if countries:
+        country, = countries
+    else:
+        country = Country(name='Argentina', code='AR')
+        country.save()
+    subdivisions = Subdivision.find([('code', '=', 'AR-B')])
+    if subdivisions:
+        subdivision, = subdivisions
+    else:
+        subdivision = Subdivision(name='Buenos Aires', code='AR-B',
+            type='province', country=country)
+        subdivision.save()
+    return subdivision
+
+
+def _create_company(name, today):
+    Company = Model.get('company.company')
+    Party = Model.get('party.party')
+
+    subdivision = _get_subdivision()
+    party = Party(name=name)
+    party.iva_condition = 'responsable_inscripto'
+    identifier = party.identifiers.new()
+    identifier.type = 'ar_vat'
+    identifier.code = _vat_number(next(_vat_indexes))
+    address, = party.addresses
+    address.country = subdivision.country
+    address.subdivision = subdivision
+    address.invoice = True
+    party.save()
+    create_company(party=party, currency=get_currency('ARS'))
+    company, = Company.find([('party', '=', party.id)])
+
+    fiscalyear = set_fiscalyear_voucher_sequences(
+        set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company, today=today)))
+    fiscalyear.click('create_period')
+    create_chart(company, chart='account_ar.root_ar')
+    return company, subdivision
+
+
+def _create_regimes(company, subdivision, accounts):
+    Retencion = Model.get('account.retencion')
+
+    sequence = create_retencion_sequence(company)
+    ganancias = Retencion(name='Ganancias', type='efectuada', tax='gana',
+        account=accounts['tax'], sequence=sequence,
+        minimum_non_taxable_amount=Decimal(67170),
+        rate_registered=Decimal(2), rate_non_registered=Decimal(28),
+        minimum_withholdable_amount=Decimal(240))
+    start = Decimal(0)
+    for end, rate, fixed in [
+            (Decimal(8000), Decimal(5), Decimal(0)),
+            (Decimal(16000), Decimal(9), Decimal(400)),
+            (Decimal(24000), Decimal(12), Decimal(1120)),
+            (None, Decimal(35), Decimal(2080))]:
+        ganancias.scales.new(start_amount=start, end_amount=end, rate=rate,
+            fixed_withholdable_amount=fixed, minimum_non_taxable_amount=start)
+        start = end + Decimal('0.01') if end is not None else None
+    ganancias.save()
+    iva = Retencion(name='IVA', type='efectuada', tax='iva',
+        account=accounts['tax'], sequence=sequence,
+        rate_registered=Decimal(50),
+        minimum_withholdable_amount=Decimal(400))
+    iva.save()
+    iibb = Retencion(name='IIBB', type='efectuada', tax='iibb',
+        account=accounts['tax'], sequence=sequence,
+        subdivision=subdivision, rate_registered=Decimal('1.75'),
+        rate_non_registered=Decimal('3.5'))
+    iibb.save()
+
+    company.ganancias_agente_retencion = True
+    company.ganancias_regimen_retencion = ganancias
+    company.iva_agente_retencion = True
+    company.iva_regimen_retencion = iva
+    company.iibb_agente_retencion = True
+    company.iibb_regimenes_retencion.append(Retencion(iibb.id))
+    company.save()
+    return ganancias, iva, iibb
+
+
+def _create_parties(count, regimes, accounts, today, rng):
+    Party = Model.get('party.party')
+
+    _, _, iibb = regimes
+    parties = []
+    for _ in range(count):
+        index = next(_vat_indexes)
+        party = Party(name='Supplier %s' % index)
+        party.iva_condition = rng.choice(IVA_CONDITIONS)
+        party.ganancias_condition = rng.choice(GANANCIAS_CONDITIONS)
+        party.iibb_condition = rng.choice(IIBB_CONDITIONS)
+        party.account_payable = accounts['payable']
+        identifier = party.identifiers.new()
+        identifier.type = 'ar_vat'
+        identifier.code = _vat_number(index)
+        if rng.random() < 0.1:
+            party.exemptions.new(tax=iibb,
+                end_date=today + relativedelta(years=1))
+        parties.append(party)
+    Party.save(parties)
+    return parties
+
+
+def _create_invoices(parties, per_party, date, accounts, rng):
+    Invoice = Model.get('account.invoice')
+
+    invoices = []
+    for party in parties:
+        for _ in range(per_party):
+            invoice = Invoice(type='in', party=party, invoice_date=date)
+            invoice.payment_term = None
+            line = invoice.lines.new()
+            line.account = accounts['expense']
+            line.description = 'Service'
+            line.quantity = 1
+            line.unit_price = Decimal(rng.randint(1000, 200000))
+            invoices.append(invoice)
+    Invoice.save(invoices)
+    Invoice.click(invoices, 'validate_invoice')
+    Invoice.click(invoices, 'post')
+    return invoices
+
+
+def _create_vouchers(parties, date, paymode, journal, currency):
+    Voucher = Model.get('account.voucher')
+
+    vouchers = []
+    for party in parties:
+        voucher = Voucher(party=party, date=date, voucher_type='payment',
+            journal=journal, currency=currency)
+        amount = Decimal(0)
+        for line in voucher.lines:
+            line.amount = line.amount_unreconciled
+            amount += line.amount
+        if not amount:
+            continue
+        voucher.pay_lines.new(pay_mode=paymode, pay_amount=amount)
+        vouchers.append(voucher)
+    Voucher.save(vouchers)
+    return vouchers
+
+
+def generate_dataset(size, companies=1, invoices_per_party=3, months=2,
+        today=None, seed=0):
+    '''
+    Generate size parties with their supplier invoices for each of the
+    companies and post months of payment history before today.
+    Return the companies, parties, the draft payments of today and the
+    objects needed to create payments.
+    '''
+    Journal = Model.get('account.journal')
+    Paymode = Model.get('account.voucher.paymode')
+    Voucher = Model.get('account.voucher')
+
+    rng = random.Random(seed)
+    if today is None:
+        # Keep the history in the fiscal year of today
+        today = dt.date.today().replace(day=15)
+        if today.month <= months:
+            today = today.replace(month=months + 1)
+    dataset = {
+        'companies': [],
+        'parties': [],
+        'vouchers': [],
+        'invoices': 0,
+        }
+    for c in range(companies):
+        company, subdivision = _create_company(
+            'Company %s-%s' % (size, c), today)
+        accounts = get_accounts(company)
+        accounts['tax'] = accounts['sale_tax']
+        regimes = _create_regimes(company, subdivision, accounts)
+        journal, = Journal.find([('type', '=', 'cash')])
+        paymode = Paymode(name='Cash', account=accounts['cash'])
+        paymode.save()
+
+        parties = _create_parties(size, regimes, accounts, today, rng)
+        for month in range(months, 0, -1):
+            date = today - relativedelta(months=month)
+            dataset['invoices'] += len(_create_invoices(
+                    parties, invoices_per_party, date, accounts, rng))
+            history = _create_vouchers(
+                parties, date, paymode, journal, company.currency)
+            Voucher.click(history, 'calculate')
+            Voucher.click(history, 'post')
+        dataset['invoices'] += len(_create_invoices(
+                parties, invoices_per_party, today, accounts, rng))
+        dataset['companies'].append(company)
+        dataset['parties'].extend(parties)
+        dataset['vouchers'].extend(
+            _create_vouchers(
+                parties, today, paymode, journal, company.currency))
+    return dataset
+
+
+def _time(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def _recalculate(vouchers):
+    for voucher in vouchers:
+        recalculate = Wizard(
+            'account.voucher.recalculate_withholdings', [voucher])
+        recalculate.execute('recalculate')
+
+
+def run_benchmark(sizes, recalculate=50, **kwargs):
+    'Return the timings of the operations for each size'
+    Voucher = Model.get('account.voucher')
+
+    results = []
+    for size in sizes:
+        dataset = generate_dataset(size, **kwargs)
+        vouchers = dataset['vouchers']
+        timings = {
+            'calculate': _time(Voucher.click, vouchers, 'calculate'),
+            'recalculate': _time(_recalculate, vouchers[:recalculate]),
+            'post': _time(Voucher.click, vouchers, 'post'),
+            }
+        counts = {
+            'calculate': len(vouchers),
+            'recalculate': len(vouchers[:recalculate]),
+            'post': len(vouchers),
+            }
+        for operation, seconds in timings.items():
+            results.append({
+                    'size': size,
+                    'companies': len(dataset['companies']),
+                    'parties': len(dataset['parties']),
+                    'invoices': dataset['invoices'],
+                    'operation': operation,
+                    'vouchers': counts[operation],
+                    'seconds': seconds,
+                    'seconds_per_voucher': (
+                        seconds / counts[operation]
+                        if counts[operation] else None),
+                    })
+    return results
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the withholding calculation")
+    parser.add_argument('--size', dest='sizes', type=int, action='append',
+        help="number of parties (repeat for several sizes)")
+    parser.add_argument('--companies', type=int, default=1)
+    parser.add_argument('--invoices', dest='invoices_per_party', type=int,
+        default=3, help="supplier invoices per party and month")
+    parser.add_argument('--months', type=int, default=2,
+        help="months of posted payment history")
+    parser.add_argument('--recalculate', type=int, default=50,
+        help="number of vouchers run through the recalculate wizard")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='-',
+        help="JSON file of the results ('-' for standard output)")
+    options = parser.parse_args(arguments)
+
+    activate_modules('account_retencion_ar')
+    results = run_benchmark(options.sizes or [10, 100],
+        recalculate=options.recalculate, companies=options.companies,
+        invoices_per_party=options.invoices_per_party,
+        months=options.months, seed=options.seed)
+    report = {
+        'date': dt.datetime.now().isoformat(),
+        'backend': trytond_config.get('database', 'uri', default='')
+        .split(':', 1)[0],
+        'python': platform.python_version(),
+        'trytond': trytond_version,
+        'results': results,
+        }
+    if options.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,432 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime as dt
+import io
+import os
+import tempfile
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+
+from trytond.exceptions import UserError
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 
 
 class RetencionArTestCase(CompanyTestMixin, ModuleTestCase):
     'Test account_retencion_ar module'
     module = 'account_retencion_ar'
 
+    def test_scale_index_lookup(self):
+        'Test scale index lookup'
+        from trytond.modules.account_retencion_ar.account_retencion_ar import (
+            ScaleBracket, ScaleIndex)
+
+        brackets = [
+            ScaleBracket(Decimal(0), Decimal(8000), Decimal(5),
+                Decimal(0), Decimal(0)),
+            ScaleBracket(Decimal(8000), Decimal(16000), Decimal(9),
+                Decimal(8000), Decimal(400)),
+            ScaleBracket(Decimal('16000.01'), None, Decimal(12),
+                Decimal(16000), Decimal(1120)),
+            ]
+        index = ScaleIndex(brackets)
+
+        for amount, bracket in [
+                (Decimal(-1), None),
+                (Decimal(0), brackets[0]),
+                (Decimal(8000), brackets[0]),
+                (Decimal('8000.01'), brackets[1]),
+                (Decimal(16000), brackets[1]),
+                (Decimal('16000.005'), None),
+                (Decimal(10 ** 9), brackets[2]),
+                ]:
+            self.assertIs(index.lookup(amount), bracket, msg=amount)
+
+    def test_scale_index_lookup_overlap(self):
+        'Test scale index lookup with overlapping brackets'
+        from trytond.modules.account_retencion_ar.account_retencion_ar import (
+            ScaleBracket, ScaleIndex)
+
+        brackets = [
+            ScaleBracket(Decimal(0), Decimal(100), Decimal(1),
+                Decimal(0), Decimal(0)),
+            ScaleBracket(Decimal(50), Decimal(200), Decimal(2),
+                Decimal(0), Decimal(0)),
+            ]
+        index = ScaleIndex(brackets)
+
+        self.assertIs(index.lookup(Decimal(75)), brackets[0])
+        self.assertIs(index.lookup(Decimal(150)), brackets[1])
+
+    @with_transaction()
+    def test_scale_validation(self):
+        'Test validation of the scales modified alone'
+        pool = Pool()
+        Account = pool.get('account.account')
+        WithholdingType = pool.get('account.retencion')
+        Scale = pool.get('account.retencion.scale')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            account, = Account.search([('type', '!=', None)], limit=1)
+            regime = WithholdingType(name='Ganancias', type='efectuada',
+                tax='gana', account=account, scales=[
+                    Scale(start_amount=Decimal(0), end_amount=Decimal(8000),
+                        rate=Decimal(5)),
+                    Scale(start_amount=Decimal(8000), end_amount=None,
+                        rate=Decimal(9)),
+                    ])
+            regime.save()
+
+            first, second = regime.scales
+            Scale.write([second], {'end_amount': Decimal(16000)})
+            Scale.create([{
+                        'retencion': regime.id,
+                        'start_amount': Decimal(16000),
+                        'rate': Decimal(12),
+                        }])
+
+            with self.assertRaises(UserError):
+                Scale.create([{
+                            'retencion': regime.id,
+                            'start_amount': Decimal(10000),
+                            'rate': Decimal(12),
+                            }])
+            with self.assertRaises(UserError):
+                Scale.write([first], {'end_amount': Decimal(9000)})
+
+    def test_withholding_type_sequence(self):
+        'Test sequence of withholding type values by company'
+        from trytond.modules.account_retencion_ar.account_retencion_ar import (
+            WithholdingTypeValues)
+
+        def values(sequences):
+            return WithholdingTypeValues(id=1, tax='gana', subdivision=None,
+                regime_code=None, regime_name=None,
+                minimum_non_taxable_amount=None, rate_registered=None,
+                rate_non_registered=None, minimum_withholdable_amount=None,
+                scales=None, sequences=sequences)
+
+        self.assertEqual(values(((1, 10), (None, 20))).get_sequence(1), 10)
+        self.assertEqual(values(((1, 10), (None, 20))).get_sequence(2), 20)
+        self.assertEqual(values(((None, 20), (1, 10))).get_sequence(1), 20)
+        self.assertEqual(values(((1, 10),)).get_sequence(None), None)
+        self.assertEqual(values(((None, 20),)).get_sequence(None), 20)
+        self.assertEqual(values(((1, 10),)).get_sequence(2), None)
+
+    def test_compute_withholding(self):
+        'Test compute withholding'
+        from trytond.modules.account_retencion_ar.withholding import (
+            WithholdingInput, compute_withholding)
+
+        result = compute_withholding(WithholdingInput(
+                payment_amount=Decimal(100000),
+                rate=Decimal(9),
+                accumulated_amount=Decimal(20000),
+                accumulated_withheld=Decimal(500),
+                minimum_non_taxable_amount=Decimal(67170),
+                minimum_withholdable_amount=Decimal(240),
+                scale_non_taxable_amount=Decimal(8000),
+                scale_fixed_amount=Decimal(400)))
+
+        self.assertEqual(result.accumulated_amount, Decimal(120000))
+        self.assertEqual(result.taxable_amount, Decimal(52830))
+        self.assertEqual(result.computed_amount, Decimal('4434.70'))
+        self.assertEqual(result.amount, Decimal('3934.70'))
+
+    def test_compute_withholding_below_minimum(self):
+        'Test compute withholding below minimum amounts'
+        from trytond.modules.account_retencion_ar.withholding import (
+            WithholdingInput, compute_withholding)
+
+        for input in [
+                WithholdingInput(Decimal(100), Decimal(3),
+                    minimum_non_taxable_amount=Decimal(200)),
+                WithholdingInput(Decimal(100), Decimal(0)),
+                WithholdingInput(Decimal(100), Decimal(3),
+                    minimum_withholdable_amount=Decimal(10)),
+                ]:
+            self.assertIsNone(compute_withholding(input))
+
+    @with_transaction()
+    def test_withholding_bases(self):
+        'Test withholding bases quantize the payment share by line'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+
+        quantize = Decimal('0.01')
+        payment_rate = Decimal('0.333333')
+        invoice = Invoice(lines=[
+                InvoiceLine(type='line', amount=Decimal(100),
+                    ganancias_regimen=None),
+                InvoiceLine(type='comment'),
+                InvoiceLine(type='line', amount=Decimal(100),
+                    ganancias_regimen=None),
+                ])
+
+        # Computation of the payment amount from the invoice lines
+        baseline = sum((l.amount * payment_rate).quantize(quantize)
+            for l in invoice.lines if l.type == 'line')
+        bases = invoice._compute_withholding_bases()
+
+        self.assertEqual(bases, [(None, Decimal(100)), (None, Decimal(100))])
+        self.assertEqual(
+            sum((a * payment_rate).quantize(quantize) for _, a in bases),
+            baseline)
+        self.assertEqual(baseline, Decimal('66.66'))
+
+    @with_transaction()
+    def test_sequence_names(self):
+        'Test reservation of withholding numbers'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        TaxWithholdingSubmitted = pool.get('account.retencion.efectuada')
+
+        for model in ['ir.sequence', 'ir.sequence.strict']:
+            Sequence = pool.get(model)
+            sequence = Sequence(name='Retenciones', prefix='R-', padding=4,
+                number_increment=2, sequence_type=ModelData.get_id(
+                    'account_retencion_ar', 'seq_type_account_retencion'))
+            sequence.save()
+
+            self.assertEqual(
+                TaxWithholdingSubmitted.get_sequence_names(sequence, 0), [])
+            self.assertEqual(
+                TaxWithholdingSubmitted.get_sequence_names(sequence, 3),
+                ['R-0001', 'R-0003', 'R-0005'], msg=model)
+            self.assertEqual(sequence.get(), 'R-0007', msg=model)
+
+    @with_transaction()
+    def test_payment_run_states(self):
+        'Test states of the payment run tasks'
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        Error = pool.get('ir.error')
+        Voucher = pool.get('account.voucher')
+
+        now = dt.datetime.now()
+        tasks = Queue.create([{
+                    'name': 'account.voucher.calculate',
+                    'data': {},
+                    'dequeued_at': dequeued_at,
+                    'finished_at': finished_at,
+                    } for dequeued_at, finished_at in [
+                    (None, None),
+                    (now, None),
+                    (now, now),
+                    (now - dt.timedelta(days=1), None),
+                    (now, None),
+                    ]])
+        Error.create([{
+                    'origin': str(tasks[-1]),
+                    'message': 'Error',
+                    }])
+        missing = max(t.id for t in tasks) + 1
+
+        self.assertEqual(
+            Voucher.get_payment_run_states({
+                    1: tasks[0].id,
+                    2: tasks[1].id,
+                    3: tasks[2].id,
+                    4: tasks[3].id,
+                    5: tasks[4].id,
+                    6: missing,
+                    }), {
+                1: 'pending',
+                2: 'pending',
+                3: 'done',
+                4: 'failed',
+                5: 'failed',
+                6: 'failed',
+                })
+
+    @with_transaction()
+    def test_instrumentation(self):
+        'Test instrumentation of phases'
+        from trytond.modules.account_retencion_ar import instrumentation
+
+        @instrumentation.phase('step')
+        def step():
+            return [1, 2, 3]
+
+        summaries = []
+        step()
+        self.assertEqual(summaries, [])
+
+        instrumentation.add_listener(summaries.append)
+        try:
+            with instrumentation.profile('test', voucher=1):
+                step()
+        finally:
+            instrumentation.remove_listener(summaries.append)
+
+        summary, = summaries
+        self.assertEqual(summary['name'], 'test')
+        self.assertEqual(summary['voucher'], 1)
+        self.assertEqual(
+            [(p['name'], p['level']) for p in summary['phases']],
+            [('test', 0), ('step', 1)])
+        self.assertTrue(all(p['queries'] >= 0 and p['duration'] >= 0
+                for p in summary['phases']))
+
+    @with_transaction()
+    def test_padron_import(self):
+        'Test import of padrón and rate lookup'
+        pool = Pool()
+        Country = pool.get('country.country')
+        Subdivision = pool.get('country.subdivision')
+        Padron = pool.get('party.padron.iibb')
+        Line = pool.get('party.padron.iibb.line')
+
+        country = Country(name='Argentina', code='AR')
+        country.save()
+        subdivision = Subdivision(name='Buenos Aires', code='AR-B',
+            type='province', country=country)
+        subdivision.save()
+
+        data = (
+            'P;25092024;01102024;31102024;20000000028;D;N;N;1,50;00;\r\n'
+            'R;25092024;01102024;31102024;20000000028;D;N;N;0,75;00;\r\n'
+            'P;25092024;01102024;31102024;30000000007;D;N;N;3,00;00;\r\n')
+        padron = Padron.import_file(io.BytesIO(data.encode('latin-1')),
+            subdivision, 'arba', filename='padron.txt')
+
+        self.assertEqual(padron.state, 'active')
+        self.assertEqual(padron.start_date, dt.date(2024, 10, 1))
+        self.assertEqual(padron.end_date, dt.date(2024, 10, 31))
+        for vat_number, date, kind, rate in [
+                ('20000000028', dt.date(2024, 10, 15), 'perception',
+                    Decimal('1.5')),
+                ('20000000028', dt.date(2024, 10, 15), 'withholding',
+                    Decimal('0.75')),
+                ('30000000007', dt.date(2024, 10, 15), 'withholding', None),
+                ('20000000028', dt.date(2024, 11, 1), 'perception', None),
+                ]:
+            self.assertEqual(
+                Padron.get_rate(subdivision, vat_number, date, kind), rate,
+                msg=(vat_number, date, kind))
+
+        hit, miss = Padron._rates_cache.hit, Padron._rates_cache.miss
+        self.assertIsNone(Padron.get_rate(subdivision, '20000000028',
+                dt.date(2024, 11, 1), 'withholding'))
+        self.assertEqual(Padron._rates_cache.hit, hit + 1)
+        self.assertEqual(Padron._rates_cache.miss, miss)
+
+        data = 'P;25102024;01102024;31102024;20000000028;D;N;N;2,00;00;\r\n'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'padron.txt')
+            with open(path, 'wb') as file:
+                file.write(data.encode('latin-1'))
+            new_padron = Padron.import_path(path, subdivision, 'arba')
+
+        self.assertEqual(new_padron.filename, 'padron.txt')
+        self.assertEqual(Padron(padron.id).state, 'replaced')
+        self.assertEqual(Padron(new_padron.id).state, 'active')
+        self.assertEqual(
+            Padron.get_rate(subdivision, '20000000028',
+                dt.date(2024, 10, 15), 'perception'),
+            Decimal(2))
+
+        with self.assertRaises(UserError):
+            Padron.delete([new_padron])
+        Padron.delete([padron])
+        self.assertEqual(Line.search([], count=True), 1)
+
+    @with_transaction()
+    def test_ledger(self):
+        'Test withholding ledger amounts and rebuild'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Account = pool.get('account.account')
+        WithholdingType = pool.get('account.retencion')
+        Ledger = pool.get('account.retencion.ledger')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            account, = Account.search([('type', '!=', None)], limit=1)
+            party = Party(name='Party', iva_condition='consumidor_final')
+            party.save()
+            regime = WithholdingType(name='Ganancias', type='efectuada',
+                tax='gana', account=account)
+            regime.save()
+
+            month = Ledger.get_month(dt.date(2024, 10, 15))
+            key = (company.id, party.id, month, regime.id)
+            Ledger.add_amounts({key: (Decimal(1000), Decimal(20))})
+            Ledger.add_amounts({key: (Decimal(500), Decimal(0))})
+            self.assertEqual(
+                Ledger.get_amounts({key[:3]}),
+                {key: (Decimal(1500), Decimal(20))})
+
+            Ledger.add_amounts({key: (Decimal(-500), Decimal(0))})
+            ledger, = Ledger.search([])
+            self.assertEqual(ledger.base_amount, Decimal(1000))
+            self.assertEqual(ledger.withheld_amount, Decimal(20))
+
+            # No payment is posted so the ledger must be empty
+            differences = Ledger.rebuild(company, month, month, check=True)
+            self.assertEqual(differences, [
+                    (key, (Decimal(1000), Decimal(20)),
+                        (Decimal(0), Decimal(0)))])
+            self.assertEqual(Ledger.search([], count=True), 1)
+
+            Ledger.rebuild(company, month, month)
+            self.assertEqual(Ledger.search([], count=True), 0)
+            self.assertEqual(
+                Ledger.rebuild(company, month, month, check=True), [])
+
+    @with_transaction()
+    def test_closed_period_report_cache(self):
+        'Test cache of the reports of closed periods'
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        Period = pool.get('account.period')
+        Party = pool.get('party.party')
+        Identifier = pool.get('party.identifier')
+        Report = pool.get('account.iibb_subdivision.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+            period = fiscalyear.periods[0]
+            start_date, end_date = period.start_date, period.end_date
+
+            self.assertFalse(Report._is_closed(company, start_date, end_date))
+            Period.close([period])
+            self.assertTrue(Report._is_closed(company, start_date, end_date))
+            self.assertFalse(Report._is_closed(company, start_date,
+                    end_date + relativedelta(days=1)))
+            self.assertFalse(Report._is_closed(company,
+                    start_date - relativedelta(days=1), end_date))
+
+            Report._closed_period_cache.set('key', b'report')
+            self.assertEqual(Report._closed_period_cache.get('key'), b'report')
+            Period.reopen([period])
+            self.assertIsNone(Report._closed_period_cache.get('key'))
+
+            # The reports show the names and CUITs of the parties
+            Report._closed_period_cache.set('key', b'report')
+            Party.write([company.party], {'name': 'Company'})
+            self.assertIsNone(Report._closed_period_cache.get('key'))
+
+            Report._closed_period_cache.set('key', b'report')
+            Identifier.create([{
+                        'party': company.party.id,
+                        'type': 'ar_vat',
+                        'code': '30710158254',
+                        }])
+            self.assertIsNone(Report._closed_period_cache.get('key'))
+
 
 del ModuleTestCase
@@ -1,9 +1,17 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime as dt
+from decimal import Decimal
+
+from stdnum.ar import cuit
+
 from proteus import Model
 from trytond.modules.company.tests.tools import get_company
 
-__all__ = ['create_retencion_sequence']
+__all__ = ['create_retencion_sequence', 'get_vat_number', 'get_subdivision',
+    'set_company_subdivision', 'create_withholding_regimes',
+    'create_supplier', 'create_supplier_invoice', 'create_payment',
+    'create_perception', 'create_customer', 'create_customer_invoices']
 
 
 def create_retencion_sequence(company=None, config=None):
@@ -23,3 +31,183 @@ def create_retencion_sequence(company=None, config=None):
         company=company)
     retencion_seq.save()
     return retencion_seq
+
+
+def get_vat_number(number):
+    "Return the CUIT of the number without check digit"
+    return number + cuit.calc_check_digit(number)
+
+
+def get_subdivision(config=None):
+    "Get the Buenos Aires subdivision"
+    Country = Model.get('country.country', config=config)
+    Subdivision = Model.get('country.subdivision', config=config)
+
+    countries = Country.find([('code', '=', 'AR')])
+    if countries:
+        country, = countries
+    else:
+        country = Country(name='Argentina', code='AR')
+        country.save()
+    subdivisions = Subdivision.find([('code', '=', 'AR-B')])
+    if subdivisions:
+        subdivision, = subdivisions
+    else:
+        subdivision = Subdivision(name='Buenos Aires', code='AR-B',
+            type='province', country=country)
+        subdivision.save()
+    return subdivision
+
+
+def set_company_subdivision(company, subdivision):
+    "Set the subdivision of the invoice address of the company"
+    address, = company.party.addresses
+    address.country = subdivision.country
+    address.subdivision = subdivision
+    address.invoice = True
+    company.party.save()
+
+
+def create_withholding_regimes(company, subdivision, account, config=None):
+    "Create the Ganancias and IIBB regimes withheld by the company"
+    Retencion = Model.get('account.retencion', config=config)
+
+    sequence = create_retencion_sequence(company, config=config)
+    ganancias = Retencion(name='Ganancias', type='efectuada', tax='gana',
+        account=account, sequence=sequence,
+        minimum_non_taxable_amount=Decimal(67170),
+        rate_registered=Decimal(2), rate_non_registered=Decimal(28),
+        minimum_withholdable_amount=Decimal(240))
+    ganancias.save()
+    iibb = Retencion(name='IIBB', type='efectuada', tax='iibb',
+        account=account, sequence=sequence, subdivision=subdivision,
+        rate_registered=Decimal('1.75'), rate_non_registered=Decimal('3.5'))
+    iibb.save()
+
+    company.ganancias_agente_retencion = True
+    company.ganancias_regimen_retencion = ganancias
+    company.iibb_agente_retencion = True
+    company.iibb_regimenes_retencion.append(Retencion(iibb.id))
+    company.save()
+    return ganancias, iibb
+
+
+def create_supplier(name, vat_number, account_payable, config=None):
+    "Create a supplier registered in Ganancias and IIBB"
+    Party = Model.get('party.party', config=config)
+
+    supplier = Party(name=name)
+    supplier.iva_condition = 'responsable_inscripto'
+    supplier.ganancias_condition = 'in'
+    supplier.iibb_condition = 'in'
+    supplier.account_payable = account_payable
+    identifier = supplier.identifiers.new()
+    identifier.type = 'ar_vat'
+    identifier.code = vat_number
+    supplier.save()
+    return supplier
+
+
+def create_supplier_invoice(supplier, amount, account, tax, date=None,
+        config=None):
+    "Create and post a supplier invoice of the untaxed amount"
+    Invoice = Model.get('account.invoice', config=config)
+
+    if date is None:
+        date = dt.date.today()
+    invoice = Invoice(type='in', party=supplier, invoice_date=date)
+    invoice.payment_term = None
+    line = invoice.lines.new()
+    line.account = account
+    line.taxes.append(tax)
+    line.description = 'Service'
+    line.quantity = 1
+    line.unit_price = amount
+    invoice.save()
+    invoice.click('validate_invoice')
+    invoice.click('post')
+    return invoice
+
+
+def create_payment(supplier, amount, journal, paymode, date=None,
+        config=None):
+    "Create a draft payment of the invoices of the supplier"
+    Voucher = Model.get('account.voucher', config=config)
+
+    if date is None:
+        date = dt.date.today()
+    voucher = Voucher(party=supplier, date=date)
+    voucher.voucher_type = 'payment'
+    voucher.journal = journal
+    voucher.currency = get_company(config=config).currency
+    for line in voucher.lines:
+        line.amount = line.amount_unreconciled
+    pay_line = voucher.pay_lines.new()
+    pay_line.pay_mode = paymode
+    pay_line.pay_amount = amount
+    voucher.save()
+    return voucher
+
+
+def create_perception(company, subdivision, account, config=None):
+    "Create the IIBB perception of the subdivision applied by the company"
+    TaxGroup = Model.get('account.tax.group', config=config)
+    Tax = Model.get('account.tax', config=config)
+
+    group = TaxGroup(name='Percepción IIBB', code='PIIBB', kind='sale')
+    group.afip_kind = 'provincial'
+    group.save()
+    perception = Tax(name='Percepción IIBB %s' % subdivision.name)
+    perception.description = perception.name
+    perception.group = group
+    perception.type = 'percentage'
+    perception.rate = Decimal(0)
+    perception.invoice_account = account
+    perception.credit_note_account = account
+    perception.perception_tax_code = 'iibb'
+    perception.subdivision = subdivision
+    perception.rate_registered = Decimal(3)
+    perception.rate_non_registered = Decimal(6)
+    perception.save()
+
+    company.iibb_agente_percepcion = True
+    company.iibb_regimenes_percepcion.append(Tax(perception.id))
+    company.save()
+    return perception
+
+
+def create_customer(name, vat_number, account_receivable, config=None):
+    "Create a customer registered in IIBB"
+    Party = Model.get('party.party', config=config)
+
+    customer = Party(name=name)
+    customer.iva_condition = 'responsable_inscripto'
+    customer.iibb_condition = 'in'
+    customer.account_receivable = account_receivable
+    identifier = customer.identifiers.new()
+    identifier.type = 'ar_vat'
+    identifier.code = vat_number
+    customer.save()
+    return customer
+
+
+def create_customer_invoices(customer, amounts, account, tax, date=None,
+        config=None):
+    "Create and post together a customer invoice for each untaxed amount"
+    Invoice = Model.get('account.invoice', config=config)
+
+    if date is None:
+        date = dt.date.today()
+    invoices = []
+    for amount in amounts:
+        invoice = Invoice(party=customer, invoice_date=date)
+        line = invoice.lines.new()
+        line.account = account
+        line.taxes.append(tax)
+        line.description = 'Service'
+        line.quantity = 1
+        line.unit_price = amount
+        invoices.append(invoice)
+    Invoice.save(invoices)
+    Invoice.click(invoices, 'post')
+    return [Invoice(i.id) for i in invoices]
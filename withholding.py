@@ -0,0 +1,122 @@
+# This file is part of the account_retencion_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Computation of the withheld amounts independent of the database.
+'''
+from decimal import Decimal
+
+__all__ = ['WithholdingInput', 'WithholdingResult', 'compute_withholding']
+
+_ZERO = Decimal(0)
+_HUNDRED = Decimal(100)
+_QUANTIZE = Decimal(10) ** -Decimal(2)
+
+
+class WithholdingInput(object):
+    'Amounts and parameters of a withholding to compute'
+    __slots__ = ('payment_amount', 'accumulated_amount',
+        'accumulated_withheld', 'minimum_non_taxable_amount',
+        'minimum_withholdable_amount', 'rate', 'scale_non_taxable_amount',
+        'scale_fixed_amount')
+
+    def __init__(self, payment_amount, rate, accumulated_amount=_ZERO,
+            accumulated_withheld=_ZERO, minimum_non_taxable_amount=None,
+            minimum_withholdable_amount=None, scale_non_taxable_amount=_ZERO,
+            scale_fixed_amount=_ZERO):
+        self.payment_amount = payment_amount
+        self.rate = rate
+        self.accumulated_amount = accumulated_amount
+        self.accumulated_withheld = accumulated_withheld
+        self.minimum_non_taxable_amount = minimum_non_taxable_amount or _ZERO
+        self.minimum_withholdable_amount = (
+            minimum_withholdable_amount or _ZERO)
+        self.scale_non_taxable_amount = scale_non_taxable_amount or _ZERO
+        self.scale_fixed_amount = scale_fixed_amount or _ZERO
+
+    @classmethod
+    def from_result(cls, result):
+        'Return the input from which the result has been computed'
+        return cls(
+            payment_amount=result.payment_amount,
+            rate=result.rate,
+            accumulated_amount=(
+                result.accumulated_amount - result.payment_amount),
+            accumulated_withheld=result.accumulated_withheld,
+            minimum_non_taxable_amount=result.minimum_non_taxable_amount,
+            minimum_withholdable_amount=result.minimum_withholdable_amount,
+            scale_non_taxable_amount=result.scale_non_taxable_amount,
+            scale_fixed_amount=result.scale_fixed_amount)
+
+    def __eq__(self, other):
+        if not isinstance(other, WithholdingInput):
+            return NotImplemented
+        return all(getattr(self, n) == getattr(other, n)
+            for n in self.__slots__)
+
+
+class WithholdingResult(object):
+    'Breakdown of a computed withholding'
+    __slots__ = ('payment_amount', 'accumulated_amount',
+        'minimum_non_taxable_amount', 'taxable_amount', 'rate',
+        'scale_non_taxable_amount', 'scale_fixed_amount', 'computed_amount',
+        'minimum_withholdable_amount', 'accumulated_withheld', 'amount')
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values[name])
+
+    def __eq__(self, other):
+        if not isinstance(other, WithholdingResult):
+            return NotImplemented
+        return all(getattr(self, n) == getattr(other, n)
+            for n in self.__slots__)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+                '%s=%r' % (n, getattr(self, n)) for n in self.__slots__))
+
+
+def compute_withholding(input):
+    '''
+    Return the WithholdingResult of input or None if nothing must be
+    withheld
+    '''
+    payment_amount = input.payment_amount
+    accumulated_amount = input.accumulated_amount + payment_amount
+    minimum_non_taxable_amount = input.minimum_non_taxable_amount
+    if accumulated_amount < minimum_non_taxable_amount:
+        return None
+
+    taxable_amount = accumulated_amount - minimum_non_taxable_amount
+    rate = input.rate
+    if not rate:
+        return None
+
+    scale_non_taxable_amount = input.scale_non_taxable_amount
+    computed_amount = ((taxable_amount - scale_non_taxable_amount) *
+        rate / _HUNDRED)
+    computed_amount = computed_amount.quantize(_QUANTIZE)
+
+    scale_fixed_amount = input.scale_fixed_amount
+    computed_amount += scale_fixed_amount
+
+    minimum_withholdable_amount = input.minimum_withholdable_amount
+    if computed_amount < minimum_withholdable_amount:
+        return None
+
+    accumulated_withheld = input.accumulated_withheld
+    amount = computed_amount - accumulated_withheld
+
+    return WithholdingResult(
+        payment_amount=payment_amount,
+        accumulated_amount=accumulated_amount,
+        minimum_non_taxable_amount=minimum_non_taxable_amount,
+        taxable_amount=taxable_amount,
+        rate=rate,
+        scale_non_taxable_amount=scale_non_taxable_amount,
+        scale_fixed_amount=scale_fixed_amount,
+        computed_amount=computed_amount,
+        minimum_withholdable_amount=minimum_withholdable_amount,
+        accumulated_withheld=accumulated_withheld,
+        amount=amount)